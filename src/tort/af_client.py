@@ -0,0 +1,467 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+asyncio Autofocus client
+
+AutofocusClient runs the samples search, the results polling and the
+coverage analysis calls as coroutines, so any number of outstanding
+searches can be driven from one event loop.
+
+The search stage of a run drives the client natively: its searches run as
+coroutines on a shared background event loop through call_client, so
+thousands of cookies can be outstanding without a thread for each one.
+Threads such as the coverage stage use run_sync, which runs one client
+coroutine on the same loop and waits for it. All of them share one
+keep-alive session, so the TLS handshake to Autofocus is paid once per
+pooled connection instead of once per request.
+
+'''
+
+import asyncio
+import atexit
+import heapq
+import json
+import itertools
+import random
+import threading
+import time
+import weakref
+
+import aiohttp
+
+from pan_cnc.lib import cnc_utils
+
+from .cassette import CassetteMiss, get_cassette
+from .config import get_config_float, get_config_int
+from .key_pool import daily_exceeded, get_key_pool, quota_rest
+from .metrics import metrics
+
+
+# responses worth another try - rate limited or a transient server side failure
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class AutofocusError(Exception):
+    """ raised when Autofocus rejects a request so workers can fail one hash instead of the run """
+    pass
+
+
+class AutofocusClient:
+    """
+    Autofocus API calls as coroutines
+    af_api_key holds one or more API keys, each request goes out on one of them from the key pool
+    pass a session to share its connections, otherwise the client opens its own
+    """
+
+    def __init__(self, af_ip, af_api_key, session=None):
+        self.af_ip = af_ip
+        self.af_api_key = af_api_key
+        self.keys = get_key_pool(af_api_key)
+        # AUTOFOCUS_API_URL points every call somewhere else, e.g. a stand-in server for benchmarks
+        self.api_url = cnc_utils.get_config_value('AUTOFOCUS_API_URL', f'https://{af_ip}/api/v1.0').rstrip('/')
+        self.results_url = cnc_utils.get_config_value('AUTOFOCUS_RESULTS_URL', f'{self.api_url}/samples/results/')
+        self._session = session
+        self._own_session = session is None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, url, values, action, pinned=None):
+        """
+        post values plus an API key from the pool to Autofocus and return the json response
+        connection errors, timeouts and RETRY_STATUSES are retried TORT_HTTP_RETRIES times,
+        a key Autofocus says is out of points rests and the retry goes out on another one
+        pinned is the key to use while it has points, a search cookie is pinned to the key that posted it
+        """
+
+        retries = get_config_int('TORT_HTTP_RETRIES', 3)
+        backoff = get_config_float('TORT_HTTP_RETRY_BACKOFF', 0.5)
+        metric_action = action.lower().replace(' ', '_')
+
+        for attempt in range(retries + 1):
+            key = await self._checkout(pinned)
+            body = json.dumps(dict(values, apiKey=key.key if key is not None else ''))
+            bucket_info = None
+            start = time.monotonic()
+            try:
+                status, text, latency, headers = await self._send(url, values, body, metric_action, key)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                metrics.observe_request(metric_action, 'error', time.monotonic() - start, len(body), 0)
+                if attempt == retries:
+                    raise AutofocusError(f"{action} failed to reach Autofocus: {e!r}")
+                print(f"{action} failed to reach Autofocus ({e!r}), retrying")
+            except CassetteMiss as e:
+                raise AutofocusError(f"{action} not replayed: {e}")
+            else:
+                metrics.observe_request(metric_action, status, latency, len(body), len(text.encode()))
+                if status < 400:
+                    result = json.loads(text)
+                    if isinstance(result, dict):
+                        bucket_info = result.get('bucket_info')
+                        if key is not None and 'af_cookie' in result:
+                            self.keys.pin(result['af_cookie'], key)
+                    return result
+                rest = quota_rest(status, text, headers)
+                if rest is not None and key is not None and attempt < retries:
+                    self.keys.rest(key, rest, daily=daily_exceeded(text))
+                    continue
+                if status not in RETRY_STATUSES or attempt == retries:
+                    print(text)
+                    raise AutofocusError(f"{action} rejected by Autofocus: {status} {text}")
+                print(f"{action} returned {status}, retrying")
+            finally:
+                if key is not None:
+                    self.keys.release(key, bucket_info)
+
+            await asyncio.sleep(backoff * 2 ** attempt)
+
+    async def _checkout(self, pinned=None):
+        """ the pooled key for the next request, None when the cassette replays it """
+
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            return None
+
+        return await self.keys.acquire_async(pinned)
+
+    async def _send(self, url, values, body, metric_action, key):
+        """
+        one request on key returning (status, text, seconds, headers), recorded to the cassette in record mode
+        replay mode answers from the cassette without spending points
+        """
+
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            status, text, latency = await cassette.replay(url, values)
+            return status, text, latency, {}
+
+        if self._session is None:
+            self._session = create_session()
+
+        metrics.spend_points(metric_action)
+        start = time.monotonic()
+        async with self._session.post(url, data=body, headers=JSON_HEADERS) as response:
+            text = await response.text()
+        latency = time.monotonic() - start
+
+        if cassette is not None:
+            cassette.record(url, values, response.status, text, latency, api_key=key.key)
+
+        return response.status, text, latency, response.headers
+
+    async def search(self, query, size):
+        """ post a samples search and return the search dict holding the af_cookie """
+
+        search_values = {"query": query,
+                         "size": size,
+                         "from": 0,
+                         "sort": {"create_date": {"order": "desc"}},
+                         "scope": "global",
+                         "artifactSource": "af"
+                         }
+        search_url = f'{self.api_url}/samples/search'
+
+        search_dict = await self._post(search_url, search_values, 'Search')
+        print('Search query posted to Autofocus')
+
+        return search_dict
+
+    async def poll_cookie(self, cookie):
+        """ one status/results poll for a search cookie """
+
+        cookie_url = self.results_url + cookie
+        print(f"sending {cookie_url}")
+
+        return await self._post(cookie_url, {}, 'Results poll', pinned=self.keys.pinned(cookie))
+
+    async def get_query_results(self, search_dict, wait_complete=False):
+        """
+        check for a hit and then retrieve search results when hit = 1
+        wait_complete keeps polling until Autofocus has finished the whole search
+        polling is handed to the event loop's CookiePoller alongside every other cookie
+        """
+
+        cookie = search_dict['af_cookie']
+        print(f"Tracking cookie is {cookie}")
+
+        try:
+            return await get_poller().poll(self, cookie, wait_complete)
+        finally:
+            self.keys.unpin(cookie)
+
+    async def get_coverage(self, sha256hash):
+        """ sample analysis query returning the signature coverage section """
+
+        search_values = {"coverage": 'true',
+                         "sections": ["coverage"],
+                         }
+        search_url = f'{self.api_url}/sample/{sha256hash}/analysis'
+
+        results_analysis = await self._post(search_url, search_values, 'Coverage query')
+
+        return results_analysis['coverage']
+
+    async def get_results_and_coverage(self, search_dict, sha256hash):
+        """
+        poll a search and fetch the coverage of its sample at the same time, for hashes
+        whose sha256 is already known; failures are returned in place of the result
+        """
+
+        return await asyncio.gather(self.get_query_results(search_dict), self.get_coverage(sha256hash),
+                                    return_exceptions=True)
+
+
+class SearchTimeout(AutofocusError):
+    """ raised when a search cookie is still not finished after TORT_POLL_MAX_WAIT seconds """
+    pass
+
+
+class _PendingCookie:
+    """ a search cookie waiting on its next poll """
+
+    def __init__(self, client, cookie, wait_complete, future, delay, deadline):
+        self.client = client
+        self.cookie = cookie
+        self.wait_complete = wait_complete
+        self.future = future
+        self.delay = delay
+        self.deadline = deadline
+        self.polls = 0
+
+
+class CookiePoller:
+    """
+    polls every outstanding af_cookie of an event loop from one scheduler
+    each cookie starts with a short delay that backs off exponentially with jitter
+    until Autofocus reports the search done or the cookie passes its deadline
+    """
+
+    def __init__(self, initial_delay, max_delay, max_wait):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self._pending = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def poll(self, client, cookie, wait_complete=False):
+        """ wait for the search behind cookie to finish and return its results """
+
+        loop = asyncio.get_event_loop()
+        entry = _PendingCookie(client, cookie, wait_complete, loop.create_future(),
+                               self.initial_delay, loop.time() + self.max_wait)
+        self._schedule(entry, loop.time() + self._jitter(entry.delay))
+
+        return await entry.future
+
+    def _jitter(self, delay):
+        return delay * random.uniform(0.75, 1.25)
+
+    def _schedule(self, entry, due):
+        heapq.heappush(self._pending, (due, next(self._counter), entry))
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+
+        while self._pending:
+            due = self._pending[0][0]
+            if due > loop.time():
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), due - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._pending)[2]
+            asyncio.ensure_future(self._poll_once(entry))
+
+        self._task = None
+
+    async def _poll_once(self, entry):
+        loop = asyncio.get_event_loop()
+
+        entry.polls += 1
+        try:
+            autofocus_results = await entry.client.poll_cookie(entry.cookie)
+        except Exception as e:
+            metrics.observe_polls(entry.polls)
+            entry.future.set_exception(e)
+            return
+
+        if search_finished(autofocus_results, entry.wait_complete):
+            metrics.observe_polls(entry.polls)
+            entry.future.set_result(autofocus_results)
+        elif loop.time() >= entry.deadline:
+            metrics.observe_polls(entry.polls)
+            entry.future.set_exception(
+                SearchTimeout(f"Search {entry.cookie} not finished after {self.max_wait} seconds"))
+        else:
+            entry.delay = min(entry.delay * 2, self.max_delay)
+            self._schedule(entry, min(loop.time() + self._jitter(entry.delay), entry.deadline))
+
+
+def search_finished(autofocus_results, wait_complete=False):
+    """
+    decide from a results poll whether the search is done
+    a search that Autofocus has completed is done even with zero hits,
+    without wait_complete the first hit is enough
+    """
+
+    if 'total' not in autofocus_results:
+        print('Autofocus still queuing up the search...')
+        return False
+
+    if not autofocus_results.get('af_in_progress', True):
+        return True
+
+    if not wait_complete and autofocus_results['total'] > 0:
+        return True
+
+    print(f"Autofocus search is {autofocus_results.get('af_complete_percentage', 0)}% complete...")
+    return False
+
+
+_pollers = weakref.WeakKeyDictionary()
+
+
+def get_poller():
+    """ the CookiePoller of the running event loop, sized from the TORT_POLL_* settings """
+
+    loop = asyncio.get_event_loop()
+    if loop not in _pollers:
+        _pollers[loop] = CookiePoller(get_config_float('TORT_POLL_INITIAL_DELAY', 0.5),
+                                      get_config_float('TORT_POLL_MAX_DELAY', 10),
+                                      get_config_float('TORT_POLL_MAX_WAIT', 300))
+    return _pollers[loop]
+
+
+_loop = None
+_session = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    """ event loop running on a daemon thread, shared by all synchronous callers """
+
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='autofocus-client', daemon=True).start()
+        return _loop
+
+
+class ConnectionStats:
+    """ counts connections opened versus reused across every session from create_session """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    async def on_connection_create_end(self, session, context, params):
+        with self._lock:
+            self.opened += 1
+
+    async def on_connection_reuseconn(self, session, context, params):
+        with self._lock:
+            self.reused += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'connections_opened': self.opened, 'connections_reused': self.reused}
+
+
+connection_stats = ConnectionStats()
+
+
+def create_session():
+    """
+    keep-alive session with a connection pool of TORT_HTTP_POOL_SIZE and
+    TORT_HTTP_TIMEOUT/TORT_HTTP_CONNECT_TIMEOUT seconds timeouts
+    """
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(connection_stats.on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(connection_stats.on_connection_reuseconn)
+
+    connector = aiohttp.TCPConnector(limit=get_config_int('TORT_HTTP_POOL_SIZE', 20),
+                                     keepalive_timeout=get_config_float('TORT_HTTP_KEEPALIVE', 60))
+    timeout = aiohttp.ClientTimeout(total=get_config_float('TORT_HTTP_TIMEOUT', 60),
+                                    connect=get_config_float('TORT_HTTP_CONNECT_TIMEOUT', 10))
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config])
+
+
+async def _shared_session():
+    global _session
+
+    if _session is None:
+        _session = create_session()
+    return _session
+
+
+@atexit.register
+def close_shared_session():
+    """ close the pooled connections of the shared session on the background loop """
+
+    global _session
+
+    if _session is not None and _loop is not None and _loop.is_running():
+        session, _session = _session, None
+        try:
+            asyncio.run_coroutine_threadsafe(session.close(), _loop).result(5)
+        except Exception as e:
+            print(f"Unable to close the Autofocus session--ERROR: {e}")
+
+
+async def call_client(af_ip, af_api_key, method, *args, **kwargs):
+    """ await an AutofocusClient coroutine on the shared session, from a coroutine on the background loop """
+
+    client = AutofocusClient(af_ip, af_api_key, session=await _shared_session())
+    return await getattr(client, method)(*args, **kwargs)
+
+
+def run_coroutine(coro):
+    """ run a coroutine on the background loop and wait for its result, for threads """
+
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result()
+
+
+def run_sync(af_ip, af_api_key, method, *args, **kwargs):
+    """ run an AutofocusClient coroutine on the background loop and wait for its result """
+
+    return run_coroutine(call_client(af_ip, af_api_key, method, *args, **kwargs))
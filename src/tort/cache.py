@@ -0,0 +1,160 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Local cache of Autofocus lookups
+
+Test vendors reuse the same hash sets run after run, so the sample data
+from get_sample_data and the signature coverage from get_sig_coverage are
+kept in a SQLite file keyed by hash value. Verdicts rarely change and
+coverage changes with every content release, so each has its own TTL.
+A hash Autofocus has no sample for yet may be analysed any day, so those
+results only keep for the much shorter no sample TTL.
+
+'''
+
+import sqlite3
+import threading
+import time
+
+from pan_cnc.lib import cnc_utils
+
+from .config import get_config_bool, get_config_int
+from .records import SOURCE_CACHE, HashRecord, dumps, loads
+
+COVERAGE_FIELDS = ('dns_sig', 'wf_av_sig', 'fileurl_sig')
+
+NO_SAMPLE = 'No sample found'
+
+# evicting on every write would scan the table each time, check every this many writes
+EVICT_INTERVAL = 100
+
+
+class HashCache:
+    """
+    SQLite backed cache of sample data and signature coverage per hash value
+    least recently used rows are evicted once there are more than max_entries
+    """
+
+    def __init__(self, path, verdict_ttl, coverage_ttl, max_entries, no_sample_ttl=3600):
+        self.path = path
+        self.verdict_ttl = verdict_ttl
+        self.coverage_ttl = coverage_ttl
+        self.no_sample_ttl = no_sample_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL with NORMAL syncs fsyncs at checkpoints instead of on every commit of the hot path
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS hash_cache ('
+                           'hashvalue TEXT PRIMARY KEY, '
+                           'sample_data TEXT, sample_time REAL, '
+                           'coverage TEXT, coverage_time REAL, '
+                           'access_time REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS hash_cache_access ON hash_cache (access_time)')
+        self._conn.commit()
+
+    def _get(self, column, time_column, ttl, hashvalue):
+        """ the cached value, ttl is in seconds or a function giving the seconds a cached value keeps """
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f'SELECT {column}, {time_column} FROM hash_cache WHERE hashvalue = ?',
+                                     (hashvalue.lower(),)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            value = loads(row[0])
+            if now - row[1] > (ttl(value) if callable(ttl) else ttl):
+                return None
+            self._conn.execute('UPDATE hash_cache SET access_time = ? WHERE hashvalue = ?',
+                               (now, hashvalue.lower()))
+            self._conn.commit()
+
+        return value
+
+    def _put(self, column, time_column, hashvalue, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO hash_cache (hashvalue) VALUES (?)', (hashvalue.lower(),))
+            self._conn.execute(f'UPDATE hash_cache SET {column} = ?, {time_column} = ?, access_time = ? '
+                               f'WHERE hashvalue = ?', (dumps(value), now, now, hashvalue.lower()))
+            self._writes += 1
+            if self._writes % EVICT_INTERVAL == 0:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        self._conn.execute('DELETE FROM hash_cache WHERE hashvalue IN ('
+                           'SELECT hashvalue FROM hash_cache ORDER BY access_time DESC LIMIT -1 OFFSET ?)',
+                           (self.max_entries,))
+
+    def get_sample(self, hashvalue):
+        """ cached get_sample_data result, None if missing or older than the verdict or no sample TTL """
+
+        sample_data = self._get('sample_data', 'sample_time', self._sample_ttl, hashvalue)
+        if sample_data is None:
+            return None
+
+        record = HashRecord.from_dict(sample_data)
+        record['source'] = SOURCE_CACHE
+        return record
+
+    def _sample_ttl(self, sample_data):
+        return self.no_sample_ttl if sample_data.get('verdict') == NO_SAMPLE else self.verdict_ttl
+
+    def put_sample(self, hashvalue, sample_data):
+        """ coverage fields are left out, they are cached by put_coverage with their own TTL """
+
+        self._put('sample_data', 'sample_time', hashvalue,
+                  {field: value for field, value in sample_data.items() if field not in COVERAGE_FIELDS})
+
+    def get_coverage(self, hashvalue):
+        """ cached dns_sig/wf_av_sig/fileurl_sig, None if missing or older than the coverage TTL """
+
+        return self._get('coverage', 'coverage_time', self.coverage_ttl, hashvalue)
+
+    def put_coverage(self, hashvalue, hash_data_dict):
+        self._put('coverage', 'coverage_time', hashvalue,
+                  {field: hash_data_dict[field] for field in COVERAGE_FIELDS})
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM hash_cache')
+            self._conn.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """ process wide HashCache from the TORT_CACHE_* settings, None when TORT_CACHE_ENABLED is off """
+
+    global _cache
+
+    if not get_config_bool('TORT_CACHE_ENABLED', True):
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = HashCache(cnc_utils.get_config_value('TORT_CACHE_PATH', '/tmp/tort_cache.sqlite3'),
+                               get_config_int('TORT_CACHE_VERDICT_TTL', 7 * 24 * 60 * 60),
+                               get_config_int('TORT_CACHE_COVERAGE_TTL', 24 * 60 * 60),
+                               get_config_int('TORT_CACHE_MAX_ENTRIES', 100000),
+                               get_config_int('TORT_CACHE_NO_SAMPLE_TTL', 60 * 60))
+        return _cache
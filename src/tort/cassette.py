@@ -0,0 +1,164 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Record and replay of Autofocus responses
+
+With TORT_CASSETTE_MODE = record every Autofocus request and response of
+a run is appended to a cassette, NDJSON gzip compressed when the path ends
+in .gz. Requests are keyed by URL path and a digest of the posted values
+without the API key, and the key is scrubbed from responses too, so a
+cassette can be shared.
+
+With TORT_CASSETTE_MODE = replay the responses are served back from the
+cassette in recorded order without touching Autofocus or the points
+budget, after the recorded latency or right away with
+TORT_CASSETTE_LATENCY = zero. Rerunning a customer's failing list or
+profiling TORT without network time then costs no points.
+
+'''
+
+import asyncio
+import atexit
+import collections
+import hashlib
+import json
+import os
+import threading
+from urllib.parse import urlsplit
+
+from pan_cnc.lib import cnc_utils
+
+from .result_writer import ResultWriter, iter_results
+
+OFF = 'off'
+RECORD = 'record'
+REPLAY = 'replay'
+
+SCRUBBED = '<scrubbed>'
+
+
+class CassetteMiss(Exception):
+    """ raised in replay mode for a request the cassette has no response for """
+    pass
+
+
+def request_key(url, values):
+    """ URL path plus a digest of the posted values, independent of host and API key """
+
+    values = {key: value for key, value in values.items() if key != 'apiKey'}
+    path = urlsplit(url).path
+    digest = hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+    return f'{path}#{digest}'
+
+
+class Cassette:
+    """
+    Autofocus responses on disk in the order they were recorded
+    replaying a request recorded several times, like the polls of one cookie, plays
+    each response once and then keeps answering with the last one
+    """
+
+    def __init__(self, path, mode, zero_latency=False):
+        self.path = path
+        self.mode = mode
+        self.zero_latency = zero_latency
+        self._lock = threading.Lock()
+        self._writer = None
+        self._responses = None
+
+    @property
+    def replaying(self):
+        return self.mode == REPLAY
+
+    def record(self, url, values, status, text, latency, api_key=None):
+        if api_key:
+            text = text.replace(api_key, SCRUBBED)
+
+        with self._lock:
+            if self._writer is None:
+                self._writer = ResultWriter(self.path)
+            self._writer.write({'key': request_key(url, values), 'status': status,
+                                'latency': round(latency, 4), 'response': text})
+
+    def _load(self):
+        responses = collections.defaultdict(collections.deque)
+        if os.path.exists(self.path):
+            for entry in iter_results(self.path):
+                responses[entry['key']].append(entry)
+        print(f"Loaded {sum(len(entries) for entries in responses.values())} responses from cassette {self.path}")
+
+        return responses
+
+    def _next(self, key):
+        with self._lock:
+            if self._responses is None:
+                self._responses = self._load()
+
+            entries = self._responses.get(key)
+            if not entries:
+                return None
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+    async def replay(self, url, values):
+        """ the recorded (status, text, latency) for a request """
+
+        entry = self._next(request_key(url, values))
+        if entry is None:
+            raise CassetteMiss(f"No response recorded in {self.path} for {urlsplit(url).path}")
+
+        if not self.zero_latency:
+            await asyncio.sleep(entry['latency'])
+
+        return entry['status'], entry['response'], entry['latency']
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette():
+    """ process wide Cassette from the TORT_CASSETTE_* settings, None when TORT_CASSETTE_MODE is off """
+
+    global _cassette
+
+    mode = str(cnc_utils.get_config_value('TORT_CASSETTE_MODE', OFF)).strip().lower()
+    if mode not in (RECORD, REPLAY):
+        return None
+
+    with _cassette_lock:
+        if _cassette is None or _cassette.mode != mode:
+            if _cassette is not None:
+                _cassette.close()
+            latency = str(cnc_utils.get_config_value('TORT_CASSETTE_LATENCY', 'recorded')).strip().lower()
+            _cassette = Cassette(cnc_utils.get_config_value('TORT_CASSETTE_PATH', '/tmp/tort_cassette.ndjson.gz'),
+                                 mode, zero_latency=latency == 'zero')
+        return _cassette
+
+
+@atexit.register
+def close_cassette():
+    """ put the last recorded responses on disk """
+
+    if _cassette is not None:
+        _cassette.close()
@@ -0,0 +1,55 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Typed access to the TORT settings in .panrc
+
+Values in .panrc always come back as strings, these helpers convert them
+and fall back to the default when the entry is missing or malformed.
+
+'''
+
+from pan_cnc.lib import cnc_utils
+
+
+def get_config_int(key, default):
+    """ read a .panrc value as an int """
+
+    try:
+        return int(cnc_utils.get_config_value(key, default))
+    except (TypeError, ValueError):
+        print(f"Invalid value for {key} in .panrc, using {default}")
+        return default
+
+
+def get_config_float(key, default):
+    """ read a .panrc value as a float """
+
+    try:
+        return float(cnc_utils.get_config_value(key, default))
+    except (TypeError, ValueError):
+        print(f"Invalid value for {key} in .panrc, using {default}")
+        return default
+
+
+def get_config_bool(key, default):
+    """ read a .panrc value as a bool - true/yes/1 are all accepted """
+
+    value = cnc_utils.get_config_value(key, default)
+    if isinstance(value, bool):
+        return value
+
+    return str(value).strip().lower() in ('true', 'yes', '1', 'on')
@@ -0,0 +1,95 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Signature coverage of a sample
+
+The coverage section of an Autofocus sample analysis lists the DNS,
+WildFire/AV and file URL signatures for the sample. parse_coverage keeps
+a compact record per signature - name, active or inactive and its dates -
+and coverage_status tells whether a sample has an active signature, only
+inactive ones or none at all, straight from those records.
+
+'''
+
+SIG_TYPES = ('dns_sig', 'wf_av_sig', 'fileurl_sig')
+
+ACTIVE = 'active'
+INACTIVE = 'inactive'
+NO_SIG = 'no_sig'
+
+# record field and the Autofocus fields it is read from, first one present wins
+SIGNATURE_FIELDS = (('name', ('name',)),
+                    ('domain', ('domain',)),
+                    ('create_date', ('create_date',)),
+                    ('first_release', ('first_release', 'first_daily_release')),
+                    ('latest_release', ('latest_release', 'latest_daily_release')))
+
+
+def signature_state(entry):
+    """ active or inactive from the status of a coverage entry """
+
+    status = entry.get('state', entry.get('status'))
+    if isinstance(status, str):
+        return ACTIVE if status.strip().lower() in ('true', 'active', '1') else INACTIVE
+
+    return ACTIVE if status else INACTIVE
+
+
+def parse_signature(entry):
+    """ compact record of one coverage entry, parsing a record again returns it unchanged """
+
+    record = {'state': signature_state(entry)}
+    for field, sources in SIGNATURE_FIELDS:
+        for source in sources:
+            if entry.get(source) is not None:
+                record[field] = entry[source]
+                break
+
+    return record
+
+
+def parse_coverage(coverage):
+    """ the signature records of each signature type in a coverage section """
+
+    return {sig_type: [parse_signature(entry) for entry in coverage.get(sig_type) or []]
+            for sig_type in SIG_TYPES}
+
+
+def coverage_breakdown(sample_data):
+    """ active and inactive signature counts per signature type """
+
+    breakdown = {}
+    for sig_type in SIG_TYPES:
+        counts = {ACTIVE: 0, INACTIVE: 0}
+        for signature in sample_data.get(sig_type) or []:
+            counts[signature_state(signature)] += 1
+        breakdown[sig_type] = counts
+
+    return breakdown
+
+
+def coverage_status(sample_data):
+    """ active when any signature is active, inactive when there are only inactive ones, else no_sig """
+
+    breakdown = coverage_breakdown(sample_data)
+
+    if any(counts[ACTIVE] for counts in breakdown.values()):
+        return ACTIVE
+    if any(counts[INACTIVE] for counts in breakdown.values()):
+        return INACTIVE
+
+    return NO_SIG
@@ -0,0 +1,110 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Elasticsearch as a read-through cache
+
+Runs pushed to Elasticsearch leave one document per hash in the hash-data
+index, keyed by hashvalue. With ELASTICSEARCH_CACHE_ENABLED a run first
+fetches the documents of its whole hash list with batched _mget calls and
+takes those queried less than ELASTICSEARCH_CACHE_MAX_AGE seconds ago as
+they are, so only missing and stale hashes go to Autofocus.
+
+'''
+
+import datetime
+import threading
+
+from .config import get_config_bool, get_config_int
+from .es_sink import get_es_client
+from .exporters import HASH_DOC_TYPE, HASH_INDEX
+from .metrics import metrics
+from .records import SOURCE_CACHE, HashRecord
+
+QUERY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def query_age(hash_data_dict, now):
+    """ seconds since a hash was queried, None when its query_time is missing or unreadable """
+
+    try:
+        queried = datetime.datetime.strptime(hash_data_dict['query_time'], QUERY_TIME_FORMAT)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    return (now - queried).total_seconds()
+
+
+class ElasticsearchCache:
+    """ the fresh hash documents of a hash list, fetched chunk_size ids per _mget """
+
+    def __init__(self, client, index=HASH_INDEX, max_age=24 * 60 * 60, chunk_size=1000):
+        self.client = client
+        self.index = index
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+
+    def _mget(self, hash_list):
+        response = self.client.mget(body={'ids': hash_list}, index=self.index, doc_type=HASH_DOC_TYPE)
+        return [doc['_source'] for doc in response.get('docs', []) if doc.get('found')]
+
+    def lookup(self, hash_list):
+        """
+        dict of hashvalue to the record of each hash with a document younger than max_age,
+        failed lookups and documents without a verdict count as misses
+        """
+
+        now = datetime.datetime.now()
+        records = {}
+
+        for start in range(0, len(hash_list), self.chunk_size):
+            chunk = hash_list[start:start + self.chunk_size]
+            try:
+                with metrics.time_stage('es_cache_lookup'):
+                    docs = self._mget(chunk)
+            except Exception as e:
+                print(f"Unable to read cached hashes from {self.index}, querying Autofocus for them--ERROR: {e}")
+                continue
+
+            for doc in docs:
+                age = query_age(doc, now)
+                if 'verdict' in doc and age is not None and age <= self.max_age:
+                    record = HashRecord.from_dict(doc)
+                    record['source'] = SOURCE_CACHE
+                    records[record['hashvalue']] = record
+
+        print(f"Found {len(records)} of {len(hash_list)} hashes in {self.index} from the last {self.max_age}s")
+        return records
+
+
+_es_cache = None
+_es_cache_lock = threading.Lock()
+
+
+def get_es_cache():
+    """ process wide ElasticsearchCache from the ELASTICSEARCH_CACHE_* settings, None when it is off """
+
+    global _es_cache
+
+    if not get_config_bool('ELASTICSEARCH_CACHE_ENABLED', False):
+        return None
+
+    with _es_cache_lock:
+        if _es_cache is None:
+            _es_cache = ElasticsearchCache(get_es_client(),
+                                           max_age=get_config_int('ELASTICSEARCH_CACHE_MAX_AGE', 24 * 60 * 60),
+                                           chunk_size=get_config_int('ELASTICSEARCH_CACHE_CHUNK_SIZE', 1000))
+        return _es_cache
@@ -0,0 +1,260 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Elasticsearch output for TORT runs
+
+ElasticsearchSink buffers the hash documents of a run and ships them to
+the hash-data index with the bulk helpers in chunks bounded by count,
+bytes and time, keeping track of which hashes were indexed.
+
+Documents are indexed by hashvalue, so rerunning a hash list replaces its
+documents instead of adding more. The hash-data template maps hashes,
+verdicts and tags as keywords and query_time as a date, so Elasticsearch
+does not guess a mapping per document. Large runs turn off refreshes and
+replicas of the index while they load and put them back afterwards.
+
+'''
+
+import threading
+import time
+
+from elasticsearch import helpers
+from elasticsearch_dsl import connections
+
+from pan_cnc.lib import cnc_utils
+
+from .config import get_config_float, get_config_int
+from .exporters import HASH_DOC_TYPE, HASH_INDEX
+from .metrics import metrics
+from .records import as_dict
+
+TEMPLATE_NAME = 'tort-hash-data'
+
+KEYWORD = {'type': 'keyword'}
+
+SIGNATURE_MAPPING = {'properties': {'name': KEYWORD, 'state': KEYWORD, 'domain': KEYWORD, 'create_date': KEYWORD,
+                                    'first_release': KEYWORD, 'latest_release': KEYWORD}}
+
+# Autofocus dates come as "2019-01-01 10:00:00", query_time as "2019-01-01T10:00:00"
+HASH_TEMPLATE = {
+    'index_patterns': [f'{HASH_INDEX}*'],
+    'mappings': {
+        HASH_DOC_TYPE: {
+            'properties': {
+                'hashtype': KEYWORD,
+                'hashvalue': KEYWORD,
+                'verdict': KEYWORD,
+                'filetype': KEYWORD,
+                'sha256hash': KEYWORD,
+                'create_date': {'type': 'date', 'format': 'yyyy-MM-dd HH:mm:ss||strict_date_optional_time',
+                                'ignore_malformed': True},
+                'tag': KEYWORD,
+                'dns_sig': SIGNATURE_MAPPING,
+                'wf_av_sig': SIGNATURE_MAPPING,
+                'fileurl_sig': SIGNATURE_MAPPING,
+                'coverage_status': KEYWORD,
+                'query_time': {'type': 'date', 'format': 'strict_date_optional_time'},
+                'query_tag': KEYWORD,
+                'source': KEYWORD,
+            }
+        }
+    }
+}
+
+# index settings a bulk load relaxes, with what they are while loading
+BULK_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+_client_lock = threading.Lock()
+_template_lock = threading.Lock()
+_template_installed = set()
+_bulk_lock = threading.Lock()
+# index -> [loads running, settings to restore once the last one is done]
+_bulk_loads = {}
+
+
+def get_es_client():
+    """ Elasticsearch client for ELASTICSEARCH_HOST/ELASTICSEARCH_PORT, created once and reused """
+
+    with _client_lock:
+        try:
+            return connections.get_connection('tort')
+        except KeyError:
+            host = cnc_utils.get_config_value('ELASTICSEARCH_HOST', 'localhost')
+            port = get_config_int('ELASTICSEARCH_PORT', 9200)
+            return connections.create_connection('tort', hosts=[{'host': host, 'port': port}])
+
+
+def install_template(client, index=HASH_INDEX):
+    """ put the hash-data index template, once per client and process """
+
+    with _template_lock:
+        if id(client) in _template_installed:
+            return
+        try:
+            client.indices.put_template(name=TEMPLATE_NAME, body=HASH_TEMPLATE)
+            if not client.indices.exists(index=index):
+                client.indices.create(index=index)
+            _template_installed.add(id(client))
+        except Exception as e:
+            print(f"Unable to install the {TEMPLATE_NAME} index template--ERROR: {e}")
+
+
+def start_bulk_load(client, index):
+    """ relax BULK_SETTINGS on index, the first of concurrent loads keeps the settings to restore """
+
+    with _bulk_lock:
+        load = _bulk_loads.setdefault(index, [0, None])
+        load[0] += 1
+        if load[0] > 1:
+            return
+
+        try:
+            # keyed by the concrete index name, which differs from index when it is an alias
+            current = next(iter(client.indices.get_settings(index=index).values()))['settings']['index']
+            # a load that never finished may have left the index relaxed, fall back to the defaults then
+            load[1] = {setting: None if str(current.get(setting)) == str(value) else current.get(setting)
+                       for setting, value in BULK_SETTINGS.items()}
+            client.indices.put_settings(index=index, body={'index': BULK_SETTINGS})
+            print(f"Relaxed refresh and replicas of {index} for the bulk load")
+        except Exception as e:
+            print(f"Unable to relax the settings of {index} for the bulk load--ERROR: {e}")
+
+
+def finish_bulk_load(client, index):
+    """ put back the settings start_bulk_load relaxed once the last concurrent load is done """
+
+    with _bulk_lock:
+        load = _bulk_loads.get(index)
+        if load is None:
+            return
+        load[0] -= 1
+        if load[0] > 0:
+            return
+        del _bulk_loads[index]
+
+        if load[1] is not None:
+            try:
+                client.indices.put_settings(index=index, body={'index': load[1]})
+                client.indices.refresh(index=index)
+                print(f"Restored refresh and replicas of {index}")
+            except Exception as e:
+                print(f"Unable to restore the settings of {index}, check refresh_interval and "
+                      f"number_of_replicas--ERROR: {e}")
+
+
+def loadJSON(hashJSONs, index=HASH_INDEX):
+    '''
+    Used with the ES bulkloader utility methods to index the docs in the
+    ES DB, one per hashvalue, so a rerun replaces them instead of adding more
+
+    Arguments:
+        hashJSONs {list} -- The JSON docs to be stored in the DB
+    '''
+    for hashJSON in hashJSONs:
+        yield {
+            "_op_type": "index",
+            "_index": index,
+            "_type": HASH_DOC_TYPE,
+            "_id": f"{hashJSON['hashvalue']}",
+            "_source": as_dict(hashJSON)
+        }
+
+
+class ElasticsearchSink:
+    """
+    buffer hash documents and bulk index them once ELASTICSEARCH_BULK_SIZE docs
+    are waiting or ELASTICSEARCH_FLUSH_INTERVAL seconds have passed since the last flush
+    results maps each hashvalue to SUCCESS, FAILURE or the error that stopped it
+    on_indexed is called with the hashvalues each flush indexed successfully
+    records without a verdict failed and are not indexed, so they never replace a good document
+    expected_docs of ELASTICSEARCH_BULK_TUNE_DOCS or more relax the index settings until close
+    """
+
+    def __init__(self, client=None, index=HASH_INDEX, on_indexed=None, expected_docs=0):
+        self.client = client if client is not None else get_es_client()
+        self.index = index
+        install_template(self.client, index)
+        self.bulk_load = expected_docs >= get_config_int('ELASTICSEARCH_BULK_TUNE_DOCS', 10000)
+        if self.bulk_load:
+            start_bulk_load(self.client, index)
+        self.chunk_size = get_config_int('ELASTICSEARCH_BULK_SIZE', 500)
+        self.max_chunk_bytes = get_config_int('ELASTICSEARCH_BULK_BYTES', 10 * 1024 * 1024)
+        self.flush_interval = get_config_float('ELASTICSEARCH_FLUSH_INTERVAL', 5)
+        self.thread_count = get_config_int('ELASTICSEARCH_BULK_THREADS', 1)
+        self.on_indexed = on_indexed
+        self.results = {}
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def write(self, hash_data_dict):
+        if 'verdict' not in hash_data_dict:
+            self.results[hash_data_dict.get('hashvalue')] = "FAILURE"
+            return
+
+        self._buffer.append(hash_data_dict)
+
+        if len(self._buffer) >= self.chunk_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _bulk(self, docs):
+        bulk_args = {'chunk_size': self.chunk_size,
+                     'max_chunk_bytes': self.max_chunk_bytes,
+                     'raise_on_error': False,
+                     'raise_on_exception': False}
+
+        if self.thread_count > 1:
+            return helpers.parallel_bulk(self.client, loadJSON(docs, self.index),
+                                         thread_count=self.thread_count, **bulk_args)
+
+        return helpers.streaming_bulk(self.client, loadJSON(docs, self.index), **bulk_args)
+
+    def flush(self):
+        """ index everything buffered so far """
+
+        docs, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        if not docs:
+            return
+
+        indexed = []
+        with metrics.time_stage('es_bulk'):
+            try:
+                for ok, item in self._bulk(docs):
+                    action = next(iter(item.values()))
+                    self.results[action['_id']] = "SUCCESS" if ok else "FAILURE"
+                    if ok:
+                        indexed.append(action['_id'])
+            except Exception as e:
+                for doc in docs:
+                    self.results.setdefault(doc['hashvalue'], f"Unknown error {e}")
+
+        if self.on_indexed is not None and indexed:
+            self.on_indexed(indexed)
+
+        print(f"Indexed {len(docs)} hash docs into {self.index}")
+
+    def close(self):
+        """ flush what is left and return the per hash results """
+
+        try:
+            self.flush()
+        finally:
+            if self.bulk_load:
+                self.bulk_load = False
+                finish_bulk_load(self.client, self.index)
+
+        return self.results
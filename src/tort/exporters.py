@@ -0,0 +1,195 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Result exporters for TORT runs
+
+A run hands each hash result to its Exporter once and the Exporter fans it
+out to every sink of the run: the run's own output (NDJSON results file or
+Elasticsearch), the run stats and the extra files listed in
+TORT_EXPORT_FORMATS:
+
+    ndjson   <query tag>_<date>.ndjson       one line of compact JSON per hash
+    csv      <query tag>_<date>.csv          one flattened row per hash for spreadsheets
+    es_bulk  <query tag>_<date>.bulk.ndjson  Elasticsearch _bulk index actions for loading offline
+
+The files share the buffering of ResultWriter and are gzip compressed with
+TORT_OUTPUT_COMPRESS like the results file.
+
+'''
+
+import csv
+import io
+import os
+import re
+
+from pan_cnc.lib import cnc_utils
+
+from .coverage import ACTIVE, INACTIVE, SIG_TYPES, coverage_breakdown
+from .records import dumps
+from .result_writer import ResultWriter, iter_results
+
+HASH_INDEX = 'hash-data'
+HASH_DOC_TYPE = 'document'
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+ES_BULK = 'es_bulk'
+
+EXTENSIONS = {NDJSON: '.ndjson', CSV: '.csv', ES_BULK: '.bulk.ndjson'}
+
+# spreadsheet columns, each signature type gets its active and inactive counts and the signature names
+CSV_COLUMNS = (['hashtype', 'hashvalue', 'verdict', 'filetype', 'sha256hash', 'create_date', 'tag', 'coverage_status']
+               + [f'{sig_type}{suffix}' for sig_type in SIG_TYPES for suffix in ('_active', '_inactive', '')]
+               + ['query_time', 'query_tag', 'source'])
+
+
+def export_path(out_file, export_format):
+    """ file of an export format next to the results file of a run, compressed when that is """
+
+    compressed = out_file.endswith('.gz')
+    stem = out_file[:-len('.gz')] if compressed else out_file
+    if stem.endswith('.ndjson'):
+        stem = stem[:-len('.ndjson')]
+
+    return stem + EXTENSIONS[export_format] + ('.gz' if compressed else '')
+
+
+def flatten(record):
+    """ one CSV row of a hash result, lists joined with ; """
+
+    row = {column: record.get(column, '') for column in CSV_COLUMNS if column not in SIG_TYPES}
+    row['tag'] = ';'.join(record.get('tag') or [])
+
+    for sig_type, counts in coverage_breakdown(record).items():
+        row[f'{sig_type}_active'] = counts[ACTIVE]
+        row[f'{sig_type}_inactive'] = counts[INACTIVE]
+        row[sig_type] = ';'.join(str(signature.get('name', '')) for signature in record.get(sig_type) or [])
+
+    return row
+
+
+def bulk_action(record, index=HASH_INDEX):
+    """ _bulk action line indexing a hash result under its hashvalue, so reruns overwrite it """
+
+    return {'index': {'_index': index, '_type': HASH_DOC_TYPE, '_id': record['hashvalue']}}
+
+
+class CsvWriter(ResultWriter):
+    """ hash results as flattened CSV rows, the header goes at the top of a new file """
+
+    def __init__(self, path, **kwargs):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        super().__init__(path, **kwargs)
+
+        if new_file:
+            self._file.write(self._csv_text(None))
+
+    @staticmethod
+    def _csv_text(row):
+        """ CSV text of a row, the header when row is None """
+
+        text = io.StringIO()
+        writer = csv.DictWriter(text, fieldnames=CSV_COLUMNS, lineterminator='\n')
+        if row is None:
+            writer.writeheader()
+        else:
+            writer.writerow(row)
+        return text.getvalue()
+
+    def format_record(self, record):
+        return self._csv_text(flatten(record))
+
+
+class BulkWriter(ResultWriter):
+    """
+    hash results as an Elasticsearch _bulk body, an index action line followed by the record
+    records without a verdict failed and are left out like they are from the Elasticsearch sink
+    """
+
+    def __init__(self, path, index=HASH_INDEX, **kwargs):
+        self.index = index
+        super().__init__(path, **kwargs)
+
+    def write(self, record):
+        if 'verdict' in record:
+            super().write(record)
+
+    def format_record(self, record):
+        return dumps(bulk_action(record, self.index)) + "\n" + dumps(record) + "\n"
+
+
+WRITERS = {NDJSON: ResultWriter, CSV: CsvWriter, ES_BULK: BulkWriter}
+
+
+def export_formats():
+    """ the extra export formats in TORT_EXPORT_FORMATS, unknown ones are skipped """
+
+    formats = []
+    for export_format in re.split(r'[\s,]+', str(cnc_utils.get_config_value('TORT_EXPORT_FORMATS', '')).lower()):
+        if not export_format:
+            continue
+        if export_format not in WRITERS:
+            print(f"Unknown export format {export_format} in TORT_EXPORT_FORMATS, use one of {', '.join(WRITERS)}")
+        elif export_format not in formats:
+            formats.append(export_format)
+
+    return formats
+
+
+class Exporter:
+    """
+    write each hash result to every sink once, a sink has write(record) and close()
+    close returns what each sink's close returned, by sink
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def write(self, record):
+        for sink in self.sinks:
+            sink.write(record)
+
+    def close(self):
+        return {sink: sink.close() for sink in self.sinks}
+
+
+def rewrite_exports(out_file, skip=()):
+    """ write the TORT_EXPORT_FORMATS files of a run again from its results file, after a resume compacted it """
+
+    for export_format in export_formats():
+        # the ndjson export is the results file itself
+        if export_format in skip or export_format == NDJSON:
+            continue
+        path = export_path(out_file, export_format)
+        if os.path.exists(path):
+            os.remove(path)
+        with WRITERS[export_format](path) as writer:
+            for record in iter_results(out_file):
+                writer.write(record)
+
+
+def open_exporter(out_file, sinks, skip=()):
+    """ Exporter over sinks plus a writer for each TORT_EXPORT_FORMATS format not in skip """
+
+    sinks = list(sinks)
+    for export_format in export_formats():
+        if export_format not in skip:
+            path = export_path(out_file, export_format)
+            print(f"Exporting {export_format} to {path}")
+            sinks.append(WRITERS[export_format](path))
+
+    return Exporter(sinks)
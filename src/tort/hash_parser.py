@@ -0,0 +1,90 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Hash list parsing
+
+Vendor exports and pasted lists mix newlines, commas, tabs, URL encoded
+newlines and escaped newlines. HashParser tokenizes any mix of them in a
+single pass, validates MD5, SHA-1 and SHA-256 hashes by length and hex
+digits, drops duplicates while keeping the input order and keeps the
+rejected tokens for reporting.
+
+'''
+
+import re
+import string
+
+HASH_TYPES = {32: 'MD5', 40: 'SHA1', 64: 'SHA256'}
+
+HEX_DIGITS = frozenset(string.hexdigits)
+
+# tokens are separated by whitespace, commas/semicolons/pipes, URL encoded
+# newlines (%0A, %0D) or escaped newlines (a literal backslash-n or -r)
+DELIMITER = r'%0[aAdD]|\\[nr]|[\s,;|]'
+TOKEN = re.compile(f'(?:{DELIMITER})+|((?:(?!{DELIMITER}).)+)')
+
+
+def hash_type(hashvalue):
+    """ MD5, SHA1 or SHA256 for a valid hash, None for anything else """
+
+    if len(hashvalue) in HASH_TYPES and HEX_DIGITS.issuperset(hashvalue):
+        return HASH_TYPES[len(hashvalue)]
+
+    return None
+
+
+def iter_tokens(source):
+    """
+    yield the tokens of a string, or of a file or any other iterable of lines
+    files are read a line at a time and bytes are decoded as utf-8
+    """
+
+    if isinstance(source, (str, bytes)):
+        source = [source]
+
+    for chunk in source:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8', 'replace')
+        for match in TOKEN.finditer(chunk):
+            if match.group(1) is not None:
+                yield match.group(1)
+
+
+class HashParser:
+    """
+    parse() yields the valid, unique hashes of a source lowercased and in input order
+    rejects and duplicates are counted as the source is consumed
+    """
+
+    def __init__(self):
+        self.rejects = []
+        self.duplicates = 0
+        self._seen = set()
+
+    def parse(self, source):
+        for token in iter_tokens(source):
+            hashvalue = token.lower()
+            if hash_type(hashvalue) is None:
+                self.rejects.append(token)
+            elif hashvalue in self._seen:
+                self.duplicates += 1
+            else:
+                self._seen.add(hashvalue)
+                yield hashvalue
+
+    def summary(self):
+        return {'accepted': len(self._seen), 'rejected': len(self.rejects), 'duplicates': self.duplicates}
@@ -0,0 +1,242 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Run journal for resumable TORT runs
+
+Every hash of a run moves through queued -> searched -> covered -> stored
+and the journal records each step per query tag in SQLite. When a run
+with the same query tag is started again before it finished, stored
+hashes are skipped, searched hashes poll their saved af_cookie instead of
+paying for a new search, and covered hashes are stored from the journal.
+
+A running run holds a lease on its query tag, renewed every few seconds,
+so a second job with the same query tag is refused while the first one
+is alive and only resumes the run once the lease has lapsed.
+
+'''
+
+import sqlite3
+import threading
+import time
+import uuid
+
+from pan_cnc.lib import cnc_utils
+
+from .config import get_config_float
+from .records import HashRecord, dumps, loads
+
+QUEUED = 'queued'
+SEARCHED = 'searched'
+COVERED = 'covered'
+STORED = 'stored'
+
+
+class RunInProgress(Exception):
+    """ raised when another live job is running the same query tag """
+    pass
+
+
+class JournalEntry:
+    """ journal state of one hash in a run """
+
+    def __init__(self, state=QUEUED, cookie=None, record=None):
+        self.state = state
+        self.cookie = cookie
+        self.record = record
+
+
+class RunJournal:
+    """ SQLite journal of run and hash states keyed by query tag """
+
+    def __init__(self, path, lease_seconds=60):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL with NORMAL syncs fsyncs at checkpoints instead of on every commit of the hot path
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS runs ('
+                           'query_tag TEXT PRIMARY KEY, out_file TEXT, '
+                           'started REAL, finished REAL, owner TEXT, heartbeat REAL)')
+        # journals written before runs had leases lack the owner columns
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(runs)')}
+        for column, column_type in (('owner', 'TEXT'), ('heartbeat', 'REAL')):
+            if column not in columns:
+                self._conn.execute(f'ALTER TABLE runs ADD COLUMN {column} {column_type}')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS run_hashes ('
+                           'query_tag TEXT, hashvalue TEXT, state TEXT, cookie TEXT, record TEXT, '
+                           'PRIMARY KEY (query_tag, hashvalue))')
+        self._conn.commit()
+
+    def start_run(self, query_tag, out_file, owner):
+        """
+        register a run for owner and return (out_file, resumed)
+        an unfinished run with the same query tag is resumed with its original output file,
+        unless another owner still holds its lease
+        """
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT out_file, finished, owner, heartbeat FROM runs WHERE query_tag = ?',
+                                     (query_tag,)).fetchone()
+            if row is not None and row[1] is None:
+                if row[2] not in (None, owner) and row[3] is not None and now - row[3] < self.lease_seconds:
+                    raise RunInProgress(f"A run with query tag {query_tag} is already in progress, "
+                                        f"wait for it to finish or use another query tag")
+                self._conn.execute('UPDATE runs SET owner = ?, heartbeat = ? WHERE query_tag = ?',
+                                   (owner, now, query_tag))
+                self._conn.commit()
+                return row[0], True
+
+            self._conn.execute('DELETE FROM run_hashes WHERE query_tag = ?', (query_tag,))
+            self._conn.execute('INSERT OR REPLACE INTO runs (query_tag, out_file, started, finished, owner, heartbeat) '
+                               'VALUES (?, ?, ?, NULL, ?, ?)', (query_tag, out_file, now, owner, now))
+            self._conn.commit()
+
+        return out_file, False
+
+    def renew(self, query_tag, owner):
+        """ extend the lease owner holds on a run """
+
+        with self._lock:
+            self._conn.execute('UPDATE runs SET heartbeat = ? WHERE query_tag = ? AND owner = ?',
+                               (time.time(), query_tag, owner))
+            self._conn.commit()
+
+    def release(self, query_tag, owner):
+        """ give up the lease owner holds on a run so it can be resumed right away """
+
+        with self._lock:
+            self._conn.execute('UPDATE runs SET owner = NULL, heartbeat = NULL WHERE query_tag = ? AND owner = ?',
+                               (query_tag, owner))
+            self._conn.commit()
+
+    def finish_run(self, query_tag):
+        with self._lock:
+            self._conn.execute('UPDATE runs SET finished = ? WHERE query_tag = ?', (time.time(), query_tag))
+            self._conn.commit()
+
+    def queue(self, query_tag, hash_list):
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO run_hashes (query_tag, hashvalue, state) '
+                                   'VALUES (?, ?, ?)', ((query_tag, hashvalue, QUEUED) for hashvalue in hash_list))
+            self._conn.commit()
+
+    def hashes_in_state(self, query_tag, state):
+        with self._lock:
+            rows = self._conn.execute('SELECT hashvalue FROM run_hashes WHERE query_tag = ? AND state = ?',
+                                      (query_tag, state)).fetchall()
+
+        return {row[0] for row in rows}
+
+    def get_entry(self, query_tag, hashvalue):
+        with self._lock:
+            row = self._conn.execute('SELECT state, cookie, record FROM run_hashes '
+                                     'WHERE query_tag = ? AND hashvalue = ?', (query_tag, hashvalue)).fetchone()
+
+        if row is None:
+            return JournalEntry()
+
+        return JournalEntry(row[0], row[1], HashRecord.from_dict(loads(row[2])) if row[2] else None)
+
+    def searched(self, query_tag, hash_list, cookie):
+        """ a search for these hashes was posted, cookie lets a restarted run poll it again """
+
+        with self._lock:
+            self._conn.executemany('UPDATE run_hashes SET state = ?, cookie = ? '
+                                   'WHERE query_tag = ? AND hashvalue = ?',
+                                   ((SEARCHED, cookie, query_tag, hashvalue) for hashvalue in hash_list))
+            self._conn.commit()
+
+    def reset(self, query_tag, hash_list):
+        """ forget the searches of these hashes so they are searched again """
+
+        with self._lock:
+            self._conn.executemany('UPDATE run_hashes SET state = ?, cookie = NULL '
+                                   'WHERE query_tag = ? AND hashvalue = ?',
+                                   ((QUEUED, query_tag, hashvalue) for hashvalue in hash_list))
+            self._conn.commit()
+
+    def covered(self, query_tag, hashvalue, record):
+        """ the finished hash record, ready to be stored """
+
+        self.covered_records(query_tag, {hashvalue: record})
+
+    def covered_records(self, query_tag, records):
+        """ covered for a dict of finished hash records keyed by hash value """
+
+        with self._lock:
+            self._conn.executemany('UPDATE run_hashes SET state = ?, record = ? '
+                                   'WHERE query_tag = ? AND hashvalue = ?',
+                                   ((COVERED, dumps(record), query_tag, hashvalue)
+                                    for hashvalue, record in records.items()))
+            self._conn.commit()
+
+    def stored(self, query_tag, hash_list):
+        """
+        the records are safely in the results file or Elasticsearch
+        only covered hashes count as stored, failed ones are left to be retried when the run resumes
+        """
+
+        with self._lock:
+            self._conn.executemany('UPDATE run_hashes SET state = ?, record = NULL '
+                                   'WHERE query_tag = ? AND hashvalue = ? AND state = ?',
+                                   ((STORED, query_tag, hashvalue, COVERED) for hashvalue in hash_list))
+            self._conn.commit()
+
+
+class RunLease:
+    """ holds a run's lease for this job, renewing it on a daemon thread until released """
+
+    def __init__(self, journal, query_tag, owner=None):
+        self.journal = journal
+        self.query_tag = query_tag
+        self.owner = owner or uuid.uuid4().hex
+        self._released = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._renew, name=f'lease-{self.query_tag}', daemon=True)
+        self._thread.start()
+
+    def _renew(self):
+        while not self._released.wait(self.journal.lease_seconds / 3.0):
+            try:
+                self.journal.renew(self.query_tag, self.owner)
+            except Exception as e:
+                print(f"Unable to renew the lease on run {self.query_tag}--ERROR: {e}")
+
+    def release(self):
+        self._released.set()
+        self.journal.release(self.query_tag, self.owner)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """ process wide RunJournal at TORT_JOURNAL_PATH """
+
+    global _journal
+
+    with _journal_lock:
+        if _journal is None:
+            _journal = RunJournal(cnc_utils.get_config_value('TORT_JOURNAL_PATH', '/tmp/tort_journal.sqlite3'),
+                                  get_config_float('TORT_JOURNAL_LEASE', 60))
+        return _journal
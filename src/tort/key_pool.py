@@ -0,0 +1,231 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Pool of Autofocus API keys
+
+A run can use several API keys - pasted in the form or set in
+AUTOFOCUS_API_KEY, separated by commas or whitespace - and each request
+goes out on the least used key that has points left. Every key has its own
+PointsLimiter sized by AUTOFOCUS_MINUTE_POINTS and AUTOFOCUS_DAILY_POINTS,
+kept in line with the bucket_info Autofocus returns with each response.
+
+A key whose minute or daily bucket Autofocus reports exceeded rests out of
+rotation until that bucket resets, so the run carries on with the other
+keys. Once every key rests for its daily bucket the run fails instead of
+waiting for midnight. The results of a search are polled on the key that
+posted it. Key state is process wide, jobs sharing a key share its budget.
+
+'''
+
+import asyncio
+import datetime
+import re
+import threading
+import time
+
+from .config import get_config_int
+from .rate_limit import PointsExhausted, PointsLimiter
+
+SECONDS_PER_MINUTE = 60
+
+
+def split_keys(api_keys):
+    """ the unique keys in a string of keys separated by commas or whitespace, in order """
+
+    keys = []
+    for key in re.split(r'[\s,]+', str(api_keys or '')):
+        if key and key not in keys:
+            keys.append(key)
+
+    return keys
+
+
+def seconds_to_midnight():
+    """ seconds until the Autofocus daily bucket resets at midnight UTC """
+
+    now = datetime.datetime.utcnow()
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+
+    return (midnight - now).total_seconds()
+
+
+def daily_exceeded(text):
+    """ whether an exceeded bucket response is about the daily bucket """
+
+    return 'daily' in text.lower()
+
+
+def quota_rest(status, text, headers):
+    """ seconds a key rests after a response saying its bucket is exceeded, None for any other response """
+
+    message = text.lower()
+    if status not in (409, 429) or 'bucket exceeded' not in message:
+        return None
+
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        pass
+
+    return seconds_to_midnight() if daily_exceeded(text) else SECONDS_PER_MINUTE
+
+
+class PooledKey:
+    """ an API key with its points limiter and how much it has been used """
+
+    def __init__(self, key, minute_points, daily_points):
+        self.key = key
+        self.limiter = PointsLimiter(minute_points, daily_points)
+        self.requests = 0
+        self.in_flight = 0
+        self.resting_until = 0.0
+        self.resting_daily = False
+        self.bucket_info = {}
+
+    @property
+    def name(self):
+        """ the key as it shows up in logs and stats, never in full """
+
+        return f"{self.key[:4]}...{self.key[-4:]}"
+
+    def resting(self, now):
+        return self.resting_until > now
+
+
+class KeyPool:
+    """ hand out the keys of a run by least use, keys without points left wait or are skipped """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self._lock = threading.Lock()
+        # search cookie -> the key that posted the search, its polls go out on the same key
+        self._cookies = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _take(self, key):
+        key.in_flight += 1
+        key.requests += 1
+        return key, 0
+
+    def reserve(self, pinned=None):
+        """
+        (key, 0) with a point taken from the least used key that has one, otherwise
+        (None, seconds to wait before trying again); raise once every key is out for the day,
+        by its own limiter or resting for an exceeded daily bucket
+        a pinned key is used as long as it is in rotation and has points for the day
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            if pinned is not None and not pinned.resting(now):
+                try:
+                    wait = pinned.limiter.reserve()
+                except PointsExhausted:
+                    pass
+                else:
+                    return self._take(pinned) if not wait else (None, wait)
+
+            waits = [key.resting_until - now for key in self.keys if key.resting(now) and not key.resting_daily]
+
+            for key in sorted((key for key in self.keys if not key.resting(now)),
+                              key=lambda key: (key.in_flight, key.requests)):
+                try:
+                    wait = key.limiter.reserve()
+                except PointsExhausted:
+                    continue
+                if not wait:
+                    return self._take(key)
+                waits.append(wait)
+
+        if not waits:
+            raise PointsExhausted(f"Daily Autofocus points budget of all {len(self.keys)} API keys used up")
+
+        return None, min(waits)
+
+    async def acquire_async(self, pinned=None):
+        """ wait on the event loop for a key with a point to spend """
+
+        key, wait = self.reserve(pinned)
+        while key is None:
+            await asyncio.sleep(wait)
+            key, wait = self.reserve(pinned)
+
+        return key
+
+    def pin(self, cookie, key):
+        with self._lock:
+            self._cookies[cookie] = key
+
+    def pinned(self, cookie):
+        return self._cookies.get(cookie)
+
+    def unpin(self, cookie):
+        with self._lock:
+            self._cookies.pop(cookie, None)
+
+    def release(self, key, bucket_info=None):
+        """ a request on key is done, bucket_info is the points Autofocus says the key has left """
+
+        with self._lock:
+            key.in_flight -= 1
+
+        if bucket_info:
+            key.bucket_info = bucket_info
+            key.limiter.sync(bucket_info.get('minute_points_remaining'), bucket_info.get('daily_points_remaining'))
+
+    def rest(self, key, seconds, daily=False):
+        """ take key out of rotation for seconds, daily when it is its daily bucket that ran out """
+
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until >= key.resting_until:
+                key.resting_until = until
+                key.resting_daily = daily
+        print(f"Autofocus API key {key.name} is out of {'daily' if daily else 'minute'} points, "
+              f"resting it for {int(seconds)}s")
+
+    def snapshot(self):
+        """ use and points left per key """
+
+        now = time.monotonic()
+        with self._lock:
+            return {key.name: dict(key.limiter.remaining(), requests=key.requests, in_flight=key.in_flight,
+                                   resting_seconds=max(int(key.resting_until - now), 0))
+                    for key in self.keys}
+
+
+_keys = {}
+_pools = {}
+_keys_lock = threading.Lock()
+
+
+def get_key_pool(api_keys):
+    """ KeyPool over the keys in api_keys, each key's state is shared by every pool holding it """
+
+    with _keys_lock:
+        pool = _pools.get(api_keys)
+        if pool is None:
+            keys = []
+            for key in split_keys(api_keys):
+                if key not in _keys:
+                    _keys[key] = PooledKey(key, get_config_int('AUTOFOCUS_MINUTE_POINTS', 200),
+                                           get_config_int('AUTOFOCUS_DAILY_POINTS', 14000))
+                keys.append(_keys[key])
+            pool = _pools[api_keys] = KeyPool(keys)
+        return pool
@@ -0,0 +1,235 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Run instrumentation
+
+Stage latencies, Autofocus request latencies and status codes, bytes on
+the wire, polls per search cookie, the Autofocus points spent and the
+lookups served by another job's lookup are collected process wide in
+metrics. tortMetricsView serves them in the Prometheus text format and
+processHashList prints a summary of what each run added, which shows
+where runs spend their time when sizing pools.
+
+'''
+
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a cached lookup up to a search running into TORT_POLL_MAX_WAIT
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+POLL_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    """ cumulative bucket counts plus sum and count of observed values, as Prometheus histograms """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+
+def quantile(buckets, counts, q):
+    """ upper bound of the bucket holding the q quantile, None when nothing was observed """
+
+    total = sum(counts)
+    if not total:
+        return None
+
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= q * total:
+            return buckets[index] if index < len(buckets) else float('inf')
+
+
+class Metrics:
+    """ thread safe process wide counters and histograms """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_seconds = {}
+        self.request_seconds = {}
+        self.polls_per_cookie = Histogram(POLL_BUCKETS)
+        self.responses = {}
+        self.points = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.coalesced = {}
+
+    def _observe(self, histograms, label, seconds):
+        with self._lock:
+            if label not in histograms:
+                histograms[label] = Histogram(LATENCY_BUCKETS)
+            histograms[label].observe(seconds)
+
+    def observe_stage(self, stage, seconds):
+        self._observe(self.stage_seconds, stage, seconds)
+
+    @contextmanager
+    def time_stage(self, stage):
+        """ time the body of a with block as one run of stage """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.monotonic() - start)
+
+    def observe_request(self, action, status, seconds, sent, received):
+        """ one Autofocus request, status is the HTTP status or 'error' when no response came back """
+
+        self._observe(self.request_seconds, action, seconds)
+        with self._lock:
+            key = (action, str(status))
+            self.responses[key] = self.responses.get(key, 0) + 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def spend_points(self, action, points=1):
+        with self._lock:
+            self.points[action] = self.points.get(action, 0) + points
+
+    def observe_coalesced(self, source):
+        """ a lookup answered by one already in flight or by the memo of a finished one """
+
+        with self._lock:
+            self.coalesced[source] = self.coalesced.get(source, 0) + 1
+
+    def observe_polls(self, polls):
+        with self._lock:
+            self.polls_per_cookie.observe(polls)
+
+    def snapshot(self):
+        with self._lock:
+            return {'stage_seconds': {stage: histogram.snapshot() for stage, histogram in self.stage_seconds.items()},
+                    'request_seconds': {action: histogram.snapshot()
+                                        for action, histogram in self.request_seconds.items()},
+                    'polls_per_cookie': self.polls_per_cookie.snapshot(),
+                    'responses': dict(self.responses),
+                    'points': dict(self.points),
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received,
+                    'coalesced': dict(self.coalesced)}
+
+    def render(self):
+        """ every metric in the Prometheus text exposition format """
+
+        snapshot = self.snapshot()
+        lines = []
+
+        def histogram(name, help_text, label, histograms, buckets):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for value, data in sorted(histograms.items()):
+                labels = f'{label}="{value}",' if label else ''
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], data['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                labels = f'{{{labels.rstrip(",")}}}' if labels else ''
+                lines.append(f'{name}_sum{labels} {data["sum"]}')
+                lines.append(f'{name}_count{labels} {cumulative}')
+
+        histogram('tort_stage_seconds', 'Time spent per hash or batch in each run stage',
+                  'stage', snapshot['stage_seconds'], LATENCY_BUCKETS)
+        histogram('tort_autofocus_request_seconds', 'Autofocus request latency by action',
+                  'action', snapshot['request_seconds'], LATENCY_BUCKETS)
+        histogram('tort_autofocus_polls_per_cookie', 'Results polls needed per search cookie',
+                  None, {'': snapshot['polls_per_cookie']}, POLL_BUCKETS)
+
+        lines.append('# HELP tort_autofocus_responses_total Autofocus responses by action and HTTP status')
+        lines.append('# TYPE tort_autofocus_responses_total counter')
+        for (action, status), count in sorted(snapshot['responses'].items()):
+            lines.append(f'tort_autofocus_responses_total{{action="{action}",status="{status}"}} {count}')
+
+        lines.append('# HELP tort_autofocus_points_total Estimated Autofocus points spent by action')
+        lines.append('# TYPE tort_autofocus_points_total counter')
+        for action, points in sorted(snapshot['points'].items()):
+            lines.append(f'tort_autofocus_points_total{{action="{action}"}} {points}')
+
+        lines.append('# HELP tort_autofocus_bytes_total Bytes sent to and received from Autofocus')
+        lines.append('# TYPE tort_autofocus_bytes_total counter')
+        lines.append(f'tort_autofocus_bytes_total{{direction="sent"}} {snapshot["bytes_sent"]}')
+        lines.append(f'tort_autofocus_bytes_total{{direction="received"}} {snapshot["bytes_received"]}')
+
+        lines.append('# HELP tort_coalesced_lookups_total Lookups served by one in flight or just finished')
+        lines.append('# TYPE tort_coalesced_lookups_total counter')
+        for source, count in sorted(snapshot['coalesced'].items()):
+            lines.append(f'tort_coalesced_lookups_total{{source="{source}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+
+def _diff_histogram(after, before):
+    before = before or {'counts': [0] * len(after['counts']), 'sum': 0.0}
+    return {'counts': [a - b for a, b in zip(after['counts'], before['counts'])],
+            'sum': after['sum'] - before['sum']}
+
+
+def _summarize_histogram(data, buckets):
+    count = sum(data['counts'])
+    return {'count': count,
+            'mean': round(data['sum'] / count, 4) if count else None,
+            'p50': quantile(buckets, data['counts'], 0.5),
+            'p99': quantile(buckets, data['counts'], 0.99)}
+
+
+def run_summary(before, after):
+    """
+    what happened between two snapshots, with bucket estimated p50/p99 latencies
+    runs at the same time in one process are counted in each other's summary
+    """
+
+    def histograms(key):
+        summaries = {label: _summarize_histogram(_diff_histogram(data, before[key].get(label)), LATENCY_BUCKETS)
+                     for label, data in after[key].items()}
+        return {label: summary for label, summary in summaries.items() if summary['count']}
+
+    responses = {f'{action} {status}': count - before['responses'].get((action, status), 0)
+                 for (action, status), count in after['responses'].items()}
+
+    return {'stage_seconds': histograms('stage_seconds'),
+            'request_seconds': histograms('request_seconds'),
+            'polls_per_cookie': _summarize_histogram(_diff_histogram(after['polls_per_cookie'],
+                                                                     before['polls_per_cookie']), POLL_BUCKETS),
+            'responses': {key: count for key, count in responses.items() if count},
+            'points': {action: points - before['points'].get(action, 0)
+                       for action, points in after['points'].items()
+                       if points - before['points'].get(action, 0)},
+            'bytes_sent': after['bytes_sent'] - before['bytes_sent'],
+            'bytes_received': after['bytes_received'] - before['bytes_received'],
+            'coalesced': {source: count - before['coalesced'].get(source, 0)
+                          for source, count in after['coalesced'].items()
+                          if count - before['coalesced'].get(source, 0)}}
+
+
+metrics = Metrics()
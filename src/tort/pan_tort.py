@@ -24,95 +24,73 @@ Use at your own risk.
 
 '''
 
+import asyncio
 import datetime
+import itertools
 import json
 import os
-import sys
 import time
-
-import requests
-from elasticsearch_dsl import connections
+from functools import partial
 
 from pan_cnc.lib import cnc_utils
 
+from .af_client import AutofocusError, call_client, connection_stats, get_background_loop, run_coroutine, run_sync
+from .cache import get_cache
+from .config import get_config_bool, get_config_int
+from .coverage import coverage_status, parse_coverage
+from .es_cache import get_es_cache
+from .es_sink import ElasticsearchSink
+from .exporters import NDJSON, open_exporter, rewrite_exports
+from .hash_parser import HashParser, hash_type
+from .journal import COVERED, QUEUED, SEARCHED, STORED, RunInProgress, RunLease, get_journal
+from .key_pool import get_key_pool, split_keys
+from .metrics import metrics, run_summary
+from .pipeline import Pipeline, Stage
+from .rate_limit import PointsExhausted
+from .records import SOURCE_AUTOFOCUS, HashRecord
+from .result_writer import ResultWriter, compact_results, iter_results
+from .run_stats import RunStats, stats_path
+from .single_flight import get_inflight
 
-def storeResults(results, outFile, outputType):
-    '''
-    Utility to store the results for the search based on user input either 
-    into a file or into an ES DB. 
-    
-    Arguments:
-        results {dict} -- if storing in the file it will be the json itself
-                          if storing to DB, it will be the return status of the write
-        outFile {string} -- if storing to a file, this the filename
-    '''
-    if "text" in outputType:
-        print(f"Writing results to {outFile}")
-        with open(f"{outFile}", "a") as jsonFile:
-            jsonFile.write(json.dumps(results, indent=4, sort_keys=False) + "\n")
-        return {outFile: "NULL"}
-    else:
-        print(f"Results stored in DB")
-        print(f"Results are {results}")
-        return results
-
+MALWARE_VALUES = {'0': 'benign', '1': 'malware', '2': 'grayware', '3': 'phishing'}
 
-def loadJSON(hashJSON):
-    '''
-    Used with the ES bulkloader utility method to serialize the json to be 
-    created as a do in the ES DB
-    
-    Arguments:
-        hashJSON {dict} -- The JSON to be stored in the DB
-    '''
-    yield {
-        "_index": "hash-data",
-        "_type": "document",
-        # "_id": f"{hashJSON['hashvalue']}",
-        "_source": json.dumps(hashJSON)
-    }
+# Autofocus will not return more than this many hits for a single samples search
+MAX_SEARCH_SIZE = 4000
 
+# searches are coroutines so TORT_POOL_COUNT can run high, coverage lookups still take a thread each
+MAX_COVERAGE_WORKERS = 32
 
-def init_hash_counters():
-    """
-    Use counters to create a simple output stats file in tandem with json details
-    Initialize counters to zero
-    """
 
-    hash_counters = {}
-    hash_count_values = ['total samples', 'malware', 'mal_inactive_sig', 'mal_active_sig',
-                         'mal_no_sig', 'grayware', 'benign', 'phishing', 'No sample found']
+class TortError(Exception):
+    """ raised when a TORT run can't go ahead, the message is meant for the user """
+    pass
 
-    for value in hash_count_values:
-        hash_counters[value] = 0
 
-    return hash_counters
+def get_af_host():
+    """ Autofocus host to query, AUTOFOCUS_HOST in .panrc """
 
+    return cnc_utils.get_config_value('AUTOFOCUS_HOST', 'autofocus.paloaltonetworks.com')
 
-def elk_index(hashDict):
-    """ Index setup for ELK Stack bulk install """
 
-    index_tag_full = {}
-    index_tag_inner = {}
-    index_tag_inner['_index'] = "hash-data"
-    index_tag_inner['_id'] = hashDict['hashvalue']
-    index_tag_full['index'] = index_tag_inner
+def get_hash_list(filename, parser=None):
+    """ read the hash list from file a line at a time, yielding the valid unique hashes """
 
-    return index_tag_full
+    parser = parser or HashParser()
 
+    with open(filename, 'r', encoding='utf-8-sig', errors='replace') as hash_file:
+        yield from parser.parse(hash_file)
 
-def get_hash_list(filename):
-    """ read the hash list from file and load into a list """
 
-    hash_list = []
-
-    with open(filename, 'r') as hash_file:
-        hash_list = hash_file.read().splitlines()
+async def post_search(af_ip, af_api_key, query, size):
+    """
+    post a samples search to Autofocus and return the search dict holding the af_cookie
+    get_query_results used to check status and read query results
+    """
 
-    return hash_list
+    return await call_client(af_ip, af_api_key, 'search', query, size)
 
 
-def init_query(af_ip, af_api_key, hashvalue):
+async def init_query(af_ip, af_api_key, hashvalue):
     """
     initial API query post to Autofocus
     get_query_results used to check status and read query results
@@ -122,86 +100,70 @@ def init_query(af_ip, af_api_key, hashvalue):
              "children": [{"field": "alias.hash", "operator": "contains", "value": hashvalue}]
              }
 
-    search_values = {"apiKey": af_api_key,
-                     "query": query,
-                     "size": 1,
-                     "from": 0,
-                     "sort": {"create_date": {"order": "desc"}},
-                     "scope": "global",
-                     "artifactSource": "af"
-                     }
-
-    headers = {"Content-Type": "application/json"}
-    search_url = f'https://{af_ip}/api/v1.0/samples/search'
-
-    try:
-        search = requests.post(search_url, headers=headers, data=json.dumps(search_values))
-        print('Search query posted to Autofocus')
-        search.raise_for_status()
-    except requests.exceptions.HTTPError:
-        print(search)
-        print(search.text)
-        print('\nCorrect errors and rerun the application\n')
-        sys.exit()
-
-    search_dict = {}
-    search_dict = json.loads(search.text)
+    with metrics.time_stage('search'):
+        search_dict = await post_search(af_ip, af_api_key, query, 1)
     print(f"Initial query for {hashvalue} returns {search_dict}")
 
     return search_dict
 
 
-def get_query_results(af_ip, af_api_key, search_dict):
-    """ check for a hit and then retrieve search results when hit = 1 """
+async def init_batch_query(af_ip, af_api_key, hash_list):
+    """
+    batched API query post to Autofocus - one search matching any of the hashes
+    size allows one hit per hash; hits are mapped back with map_batch_hits
+    """
+
+    query = {"operator": "any",
+             "children": [{"field": "alias.hash", "operator": "contains", "value": hashvalue}
+                          for hashvalue in hash_list]
+             }
+
+    with metrics.time_stage('batch_search'):
+        search_dict = await post_search(af_ip, af_api_key, query, min(len(hash_list), MAX_SEARCH_SIZE))
+    print(f"Batch query for {len(hash_list)} hashes returns {search_dict}")
 
-    autofocus_results = {}
+    return search_dict
 
-    cookie = search_dict['af_cookie']
-    print(f'Tracking cookie is {cookie}')
-    query_status = ''
-    results_url = cnc_utils.get_config_value('AUTOFOCUS_RESULTS_URL',
-                                             'https://autofocus.paloaltonetworks.com/api/v1.0/samples/results/')
-    cookie_url = results_url + cookie
-    headers = {"Content-Type": "application/json"}
-    results_values = {"apiKey": af_api_key}
 
-    while query_status != 'FIN':
+async def get_query_results(af_ip, af_api_key, search_dict, wait_complete=False):
+    """
+    check for a hit and then retrieve search results when hit = 1
+    wait_complete keeps polling until Autofocus has finished the whole search,
+    needed for batched queries where the first hit is not the only one wanted
+    """
 
-        time.sleep(5)
-        try:
-            print(f"sending {cookie_url}")
-            results = requests.post(url=cookie_url, headers=headers, data=json.dumps(results_values))
-            results.raise_for_status()
-        except requests.exceptions.HTTPError:
-            print(results)
-            print(results.text)
-            print('\nCorrect errors and rerun the application\n')
-            sys.exit()
-
-        autofocus_results = results.json()
-
-        if 'total' in autofocus_results:
-            if autofocus_results['total'] == 0:
-                print('Now waiting for a hit...')
-                print(autofocus_results)
-            else:
-                query_status = 'FIN'
-        else:
-            print('Autofocus still queuing up the search...')
+    with metrics.time_stage('poll'):
+        return await call_client(af_ip, af_api_key, 'get_query_results', search_dict, wait_complete=wait_complete)
 
-    return autofocus_results
 
+def add_sample_hit(hash_data_dict, sample_source):
+    """ copy verdict and sample details from an Autofocus hit into the hash data """
 
-def get_sample_data(af_ip, af_api_key, hashvalue, af_hashtype, hash_counters):
-    """ query each hash to gehashListString malware verdict and associated data """
+    verdict_num = sample_source['malware']
+    verdict_text = MALWARE_VALUES[str(verdict_num)]
+    hash_data_dict['verdict'] = verdict_text
+    hash_data_dict['filetype'] = sample_source['filetype']
+    hash_data_dict['sha256hash'] = sample_source['sha256']
+    hash_data_dict['create_date'] = sample_source['create_date']
+    if 'tag' in sample_source:
+        hash_data_dict['tag'] = sample_source['tag']
+    print(f'Hash verdict is {verdict_text}')
 
-    malware_values = {'0': 'bhashListStringnign', '1': 'malware', '2': 'grayware', '3': 'phishing'}
+    return hash_data_dict
 
-    hash_data_dict = {}
+
+async def get_sample_data(af_ip, af_api_key, hashvalue, af_hashtype, search_dict=None):
+    """
+    query each hash to get malware verdict and associated data
+    pass search_dict to read the results of a search that was already posted
+    """
+
+    hash_data_dict = HashRecord(source=SOURCE_AUTOFOCUS)
     print(f'\nworking with hash {hashvalue}')
 
-    search_dict = init_query(af_ip, af_api_key, hashvalue)
-    autofocus_results = get_query_results(af_ip, af_api_key, search_dict)
+    if search_dict is None:
+        search_dict = await init_query(af_ip, af_api_key, hashvalue)
+    autofocus_results = await get_query_results(af_ip, af_api_key, search_dict)
 
     # AFoutput is json output converted to python dictionary
 
@@ -212,252 +174,637 @@ def get_sample_data(af_ip, af_api_key, hashvalue, af_hashtype, hash_counters):
 
         # initial AF query to get sample data include sha256 hash and WF verdict
 
-        verdict_num = autofocus_results['hits'][0]['_source']['malware']
-        verdict_text = malware_values[str(verdict_num)]
-        hash_data_dict['verdict'] = verdict_text
-        hash_data_dict['filetype'] = autofocus_results['hits'][0]['_source']['filetype']
-        hash_data_dict['sha256hash'] = autofocus_results['hits'][0]['_source']['sha256']
-        hash_data_dict['create_date'] = autofocus_results['hits'][0]['_source']['create_date']
-        if 'tag' in autofocus_results['hits'][0]['_source']:
-            hash_data_dict['tag'] = autofocus_results['hits'][0]['_source']['tag']
-        print(f'Hash verdict is {verdict_text}')
-
-        hash_counters[verdict_text] += 1
+        add_sample_hit(hash_data_dict, autofocus_results['hits'][0]['_source'])
 
     # If no hash found then tag as 'no sample found'
     # These hashes can be check in VirusTotal to see if unsupported file type for Wildfire
     else:
         hash_data_dict['verdict'] = 'No sample found'
         print('\n     No sample found in Autofocus for this hash')
-        verdict_text = 'No sample found'
 
     print(f"get_sample_data() returns {hash_data_dict}")
     return hash_data_dict
 
 
-def get_sig_coverage(af_ip, af_api_key, sample_data, hash_counters):
-    """ for sample hits, second query to find signature coverage in sample analysis """
+def map_batch_hits(hash_list, autofocus_results):
+    """
+    map the hits of a batched search back to the input hashes
+    hits are sorted newest first so the first match for a hash is kept
+    """
 
-    print('Searching Autofocus for current signature coverage...')
+    hits_by_hash = {}
 
-    search_values = {"apiKey": af_api_key,
-                     "coverage": 'true',
-                     "sections": ["coverage"],
-                     }
+    for hit in autofocus_results.get('hits', []):
+        sample_source = hit['_source']
+        for field in ('md5', 'sha1', 'sha256'):
+            if field in sample_source:
+                hits_by_hash.setdefault(sample_source[field].lower(), sample_source)
 
-    headers = {"Content-Type": "application/json"}
-    hashvalue = sample_data['sha256hash']
-    search_url = f'https://{af_ip}/api/v1.0/sample/{hashvalue}/analysis'
+    return {hashvalue: hits_by_hash.get(hashvalue.lower()) for hashvalue in hash_list}
 
-    try:
-        search = requests.post(search_url, headers=headers, data=json.dumps(search_values))
-        search.raise_for_status()
-    except requests.exceptions.HTTPError:
-        print(search)
-        print(search.text)
-        print('\nCorrect errors and rerun the application\n')
-        sys.exit()
-    except Exception as e:
-        print(e)
 
-    results_analysis = {}
-    results_analysis = json.loads(search.text)
-    sample_data['dns_sig'] = results_analysis['coverage']['dns_sig']
-    sample_data['wf_av_sig'] = results_analysis['coverage']['wf_av_sig']
-    sample_data['fileurl_sig'] = results_analysis['coverage']['fileurl_sig']
+async def get_batch_sample_data(af_ip, af_api_key, hash_list, af_hashtype, search_dict=None):
+    """
+    query a batch of hashes with a single search to get malware verdict and associated data
+    returns a dict of hashvalue to the same hash data get_sample_data builds
+    pass search_dict to read the results of a batch search that was already posted
+    """
+
+    print(f'\nworking with a batch of {len(hash_list)} hashes')
 
-    # Check all the sig states [true or false] to see active vs inactive sigs for malware
+    if search_dict is None:
+        search_dict = await init_batch_query(af_ip, af_api_key, hash_list)
+    autofocus_results = await get_query_results(af_ip, af_api_key, search_dict, wait_complete=True)
 
-    if sample_data['verdict'] == 'malware':
-        sig_search = json.dumps(sample_data)
-        if sig_search.find('true') != -1:
-            hash_counters['mal_active_sig'] += 1
-        elif sig_search.find('true') == -1 and sig_search.find('false') != -1:
-            hash_counters['mal_inactive_sig'] += 1
+    batch_data = {}
+    for hashvalue, sample_source in map_batch_hits(hash_list, autofocus_results).items():
+        hash_data_dict = HashRecord(hashtype=hash_type(hashvalue) or af_hashtype, hashvalue=hashvalue,
+                                    source=SOURCE_AUTOFOCUS)
+        if sample_source:
+            add_sample_hit(hash_data_dict, sample_source)
         else:
-            hash_counters['mal_no_sig'] += 1
+            hash_data_dict['verdict'] = 'No sample found'
+            print(f'\n     No sample found in Autofocus for {hashvalue}')
+        batch_data[hashvalue] = hash_data_dict
+
+    return batch_data
+
+
+def get_sig_coverage(af_ip, af_api_key, sample_data, bypassCache=False):
+    """
+    for sample hits, second query to find signature coverage in sample analysis
+    bypassCache skips the answers other jobs finished recently, like it skips the cache
+    """
+
+    print('Searching Autofocus for current signature coverage...')
+
+    # a coverage query of the same sample from another job is shared instead of sent again
+    with metrics.time_stage('coverage'):
+        coverage = get_inflight().do(('coverage', sample_data['sha256hash']),
+                                     partial(run_sync, af_ip, af_api_key, 'get_coverage', sample_data['sha256hash']),
+                                     use_memo=not bypassCache)
+    add_coverage(sample_data, coverage)
+    sample_data['source'] = SOURCE_AUTOFOCUS
 
     print(f"get_sig_coverage() returns {sample_data}")
-    return sample_data, hash_counters
+    return sample_data
+
+
+def add_coverage(sample_data, coverage):
+    """
+    add the signature coverage from a sample analysis to the hash data as compact signature
+    records per signature type, with coverage_status active, inactive or no_sig
+    """
+
+    sample_data.update(parse_coverage(coverage))
+    sample_data['coverage_status'] = coverage_status(sample_data)
+
+    return sample_data
 
 
-def write_to_file(index, index_tag_full, hash_data_dict, hash_counters):
+async def get_sha256_sample_data(af_ip, af_api_key, hashvalue, search_dict, bypassCache=False):
     """
-    write hash data to text file; for index = 1 create new file; for index > 1 append to file
-    hash_data_estack uses the non-pretty format with index to bulk load into ElasticSearch
-    hash_data_pretty has readable formatting to view the raw hash context data
+    SHA256 fast path: the coverage query only needs the sha256, so it runs alongside
+    polling the search instead of waiting for the search to return the sha256
+    the hash data has the coverage already added when the sample was found
+    the coverage query costs a point even when there is no sample, so it is skipped when the
+    coverage is cached or another job is already fetching it, or with TORT_SHA256_COVERAGE_PREFETCH off
     """
 
-    if index == 1:
-        with open('hash_data_estack.json', 'w') as hash_file:
-            hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-            hash_file.write(json.dumps(hash_data_dict, indent=None, sort_keys=False) + "\n")
+    cache = get_cache()
+    if not get_config_bool('TORT_SHA256_COVERAGE_PREFETCH', True) or \
+            (cache is not None and not bypassCache and cache.get_coverage(hashvalue) is not None):
+        return await get_sample_data(af_ip, af_api_key, hashvalue, 'SHA256', search_dict)
 
-        with open('hash_data_pretty.json', 'w') as hash_file:
-            hash_file.write(json.dumps(hash_data_dict, indent=4, sort_keys=False) + "\n")
+    # the coverage stage waits on this fetch rather than sending its own
+    inflight = get_inflight()
+    coverageKey = ('coverage', hashvalue)
+    future, leader = inflight.claim(coverageKey, use_memo=not bypassCache)
+    if not leader:
+        return await get_sample_data(af_ip, af_api_key, hashvalue, 'SHA256', search_dict)
 
+    print(f'\nworking with SHA256 hash {hashvalue}')
+
+    try:
+        with metrics.time_stage('poll_and_coverage'):
+            autofocus_results, coverage = await call_client(af_ip, af_api_key, 'get_results_and_coverage',
+                                                            search_dict, hashvalue)
+    except Exception as e:
+        inflight.fail(coverageKey, e)
+        raise
+    if isinstance(coverage, Exception):
+        inflight.fail(coverageKey, coverage)
     else:
-        with open('hash_data_estack.json', 'a') as hash_file:
-            hash_file.write(json.dumps(index_tag_full, indent=None, sort_keys=False) + "\n")
-            hash_file.write(json.dumps(hash_data_dict, indent=None, sort_keys=False) + "\n")
+        inflight.resolve(coverageKey, coverage)
+    if isinstance(autofocus_results, Exception):
+        raise autofocus_results
 
-        with open('hash_data_pretty.json', 'a') as hash_file:
-            hash_file.write(json.dumps(hash_data_dict, indent=4, sort_keys=False) + "\n")
+    hash_data_dict = HashRecord(hashtype='SHA256', hashvalue=hashvalue, source=SOURCE_AUTOFOCUS)
 
-        with open('hash_data_stats.json', 'w') as hash_file:
-            hash_file.write(json.dumps(hash_counters, indent=4, sort_keys=False) + "\n")
+    if autofocus_results['hits']:
+        add_sample_hit(hash_data_dict, autofocus_results['hits'][0]['_source'])
+        if isinstance(coverage, Exception):
+            print(f"Coverage query failed, it will be retried--ERROR: {coverage}")
+        else:
+            add_coverage(hash_data_dict, coverage)
+    else:
+        hash_data_dict['verdict'] = 'No sample found'
+        print('\n     No sample found in Autofocus for this hash')
 
-    # print and write to file the current hash count stats
-    hash_counters['total samples'] = index
-    print('\nCurrent hash count stats:\n')
-    print(json.dumps(hash_counters, indent=4, sort_keys=False) + '\n')
-    with open('hash_data_stats.json', 'w') as hash_file:
-        hash_file.write(json.dumps(hash_counters, indent=4, sort_keys=False) + "\n")
+    print(f"get_sha256_sample_data() returns {hash_data_dict}")
+    return hash_data_dict
 
 
-def processHashList(hashList, outputType, queryTag, hashType, apiKey):
-    """hash_data main module"""
+def updateProgress(runProgress, results, progress):
+    """ count a finished hash as done or failed and report the run progress """
+
+    if 'verdict' in results:
+        runProgress['done'] += 1
+    else:
+        runProgress['failed'] += 1
+    runProgress['pending'] = runProgress['total'] - runProgress['done'] - runProgress['failed']
+
+    if progress is not None:
+        progress(runProgress)
+
+
+def processHashList(hashList, outputType, queryTag, hashType, apiKey, bypassCache=False, progress=None):
+    """
+    hash_data main module
+    progress is called with the total/done/failed/pending counts after every hash
+    and the run stats as of their last flush
+    """
 
     results = dict()
-    outResults = dict()
     fileDate = datetime.datetime.now().strftime("%y-%m-%d-%H-%M")
-    outFile = f"/tmp/{queryTag}_{fileDate}.json"
-
-    # Define the default Elasticsearch client
-    connections.create_connection(hosts=cnc_utils.get_config_value('ELASTICSEARCH_HOST', 'localhost'))
-
-    # Set the number of multi processes to use and cap it at 16 so
-    # so we don't blow out the minute points on AutoFocus
-    # multiProcNum = (app.config['TORT_POOL_COUNT'] 
-    #                 if app.config['TORT_POOL_COUNT'] <= 2 else 2)
-
-    # DEBUG_MODE means we only run 1 at a time, rather than multi-processing
-    # if app.config['DEBUG_MODE'] != True:
-    #     # Multiprocess the the hashes
-    #     print(f"Running hashes through on {multiProcNum} processes")
-    #     with Pool(multiProcNum) as pool:
-    #         results = pool.map(getHashInfo, hashList)
-    #     return storeResults(results,outFile)
-    # else:
-    for hashData in hashList:
-        results = getHashInfo(hashData, outputType, queryTag, apiKey)
-        outResults.update(storeResults(results, outFile, outputType))
+    outDir = cnc_utils.get_config_value('TORT_OUTPUT_DIR', '/tmp')
+    outFile = os.path.join(outDir, f"{queryTag}_{fileDate}.ndjson")
+    if get_config_bool('TORT_OUTPUT_COMPRESS', False):
+        outFile += ".gz"
+
+    # The run journal lets a restarted run with the same query tag pick up where it stopped,
+    # the lease keeps another job from running the same query tag at the same time
+    journal = get_journal()
+    runLease = RunLease(journal, queryTag)
+    outFile, resumed = journal.start_run(queryTag, outFile, runLease.owner)
+    journal.queue(queryTag, hashList)
+    totalCount = len(hashList)
+    exportSkip = [NDJSON] if "text" in outputType else []
+    if resumed:
+        storedHashes = journal.hashes_in_state(queryTag, STORED)
+        hashList = [hashData for hashData in hashList if hashData not in storedHashes]
+        print(f"Resuming run {queryTag}: {totalCount - len(hashList)} hashes already stored in {outFile}")
+        # the hashes searched again are written again, so their earlier records and those
+        # of failed hashes leave the results file and the exports before the run goes on
+        if os.path.exists(outFile):
+            kept = compact_results(outFile, storedHashes)
+            rewrite_exports(outFile, skip=exportSkip)
+            print(f"Kept the {kept} stored records of {outFile} for the resumed run")
+    markStored = partial(journal.stored, queryTag)
+
+    # verdict, coverage, filetype and tag tallies for the whole run, a resumed run recounts its results file
+    runStats = RunStats(stats_path(outFile), resume=resumed, results_file=outFile)
+
+    # Results go through one buffered NDJSON writer, or Elasticsearch docs are buffered across
+    # the run and bulk indexed in chunks. Hashes count as stored once that output has them,
+    # the exporter hands every result to it, the run stats and the TORT_EXPORT_FORMATS files
+    if "text" in outputType:
+        sink = ResultWriter(outFile, on_flush=markStored)
+    else:
+        sink = ElasticsearchSink(on_indexed=markStored, expected_docs=len(hashList))
+    exporter = open_exporter(outFile, [sink, runStats], skip=exportSkip)
+
+    # Hashes run through a pipeline of a search stage running TORT_POOL_COUNT searches at a time as
+    # coroutines on the Autofocus client's event loop, so an outstanding cookie doesn't hold a thread,
+    # and a coverage stage on TORT_COVERAGE_WORKERS threads, storing happens on this thread.
+    # Every Autofocus call draws from its API key's points limiter so we don't blow out the minute points
+    searchWorkers = get_config_int('TORT_POOL_COUNT', 1)
+    coverageWorkers = get_config_int('TORT_COVERAGE_WORKERS', min(searchWorkers, MAX_COVERAGE_WORKERS))
+    queueSize = max(get_config_int('TORT_QUEUE_SIZE', 100), 1)
+
+    runProgress = {'total': totalCount, 'done': totalCount - len(hashList), 'failed': 0,
+                   'pending': len(hashList), 'started': time.time()}
+    # the results file streams to the browser while the run writes it
+    if "text" in outputType:
+        runProgress['out_file'] = outFile
+    metricsBefore = metrics.snapshot()
+
+    # Hashes with a recent enough document in Elasticsearch are stored from there and
+    # only the rest go to Autofocus, unless the run bypasses cached results
+    esCache = get_es_cache() if not bypassCache else None
+    cachedRecords = esCache.lookup(hashList) if esCache is not None and hashList else {}
+    for record in cachedRecords.values():
+        record['query_tag'] = queryTag
+    journal.covered_records(queryTag, cachedRecords)
+    searchList = [hashData for hashData in hashList if hashData not in cachedRecords]
+
+    # Batching packs many hashes into one Autofocus search to save points and polling
+    # a search returns at most MAX_SEARCH_SIZE hits, larger batches would lose the hits past it
+    batchSize = max(get_config_int('TORT_BATCH_SIZE', 1), 1)
+    if batchSize > MAX_SEARCH_SIZE:
+        print(f"TORT_BATCH_SIZE {batchSize} is more than the {MAX_SEARCH_SIZE} hits a search returns, "
+              f"using {MAX_SEARCH_SIZE}")
+        batchSize = MAX_SEARCH_SIZE
+    batches = (searchList[start:start + batchSize] for start in range(0, len(searchList), batchSize))
+
+    def coverageStage(work):
+        return [getCoverageInfo(work, queryTag, apiKey, bypassCache)]
+
+    # a stage that fails passes the hashes on without sample data so they are stored as failed
+    def searchFailed(batchList, error):
+        return [(hashData, HashRecord(), None) for hashData in batchList]
+
+    def coverageFailed(work, error):
+        return [HashRecord(hashvalue=work[0], query_tag=queryTag)]
+
+    pipeline = Pipeline([Stage('search', partial(searchBatch, queryTag=queryTag, hashType=hashType,
+                                                 apiKey=apiKey, bypassCache=bypassCache), searchWorkers,
+                               on_error=searchFailed, loop=get_background_loop()),
+                         Stage('coverage', coverageStage, coverageWorkers, on_error=coverageFailed)], queueSize)
+    print(f"Running hashes through {searchWorkers} concurrent searches and {coverageWorkers} coverage threads")
+
+    # sinks are closed even when the run fails, so what was stored is on disk and the index settings are restored
+    runLease.start()
+    try:
+        try:
+            for results in itertools.chain(cachedRecords.values(), pipeline.run(batches)):
+                with metrics.time_stage('store'):
+                    exporter.write(results)
+                runProgress['stats'] = runStats.latest
+                updateProgress(runProgress, results, progress)
+        finally:
+            closed = exporter.close()
+        journal.finish_run(queryTag)
+    finally:
+        runLease.release()
+
+    runProgress['stats'] = closed[runStats]
+    if progress is not None:
+        progress(runProgress)
+    print(f"\nHash count stats for {queryTag}:\n{json.dumps(runProgress['stats']['counters'], indent=4)}\n")
+
+    print(f"Autofocus connection use: {connection_stats.snapshot()}")
+    print(f"Autofocus API key use: {get_key_pool(apiKey).snapshot()}")
+    print(f"Run metrics for {queryTag}: {json.dumps(run_summary(metricsBefore, metrics.snapshot()), indent=4)}")
+
     if "text" in outputType:
         return f"{outFile}"
     else:
-        return outResults
+        return closed[sink]
 
 
-def getHashInfo(thisHash, outputType, queryTag, apiKey):
-    print(apiKey)
-    hostname = "autofocus.paloaltonetworks.com"
-    hashType = "MD5"
-    now = datetime.datetime.now().replace(microsecond=0).isoformat('T')
-    hashCounters = init_hash_counters()
-    sampleData = {}
-    hashDataDict = {}
+async def searchSplit(hostname, apiKey, searchList, hashType, queryTag, splits):
+    """
+    sample data of the hashes found by a batched search of searchList
+    a failed search is tried again as two half size searches running side by side, at most splits
+    times over, hashes whose searches all failed are left out
+    """
+
+    cache = get_cache()
+    journal = get_journal()
 
-    # query Autofocus to get sample and signature coverage data
     try:
-        sampleData = get_sample_data(hostname, apiKey, thisHash, hashType, hashCounters)
+        searchDict = await init_batch_query(hostname, apiKey, searchList)
+        journal.searched(queryTag, searchList, searchDict['af_cookie'])
+        searchData = await get_batch_sample_data(hostname, apiKey, searchList, hashType, searchDict)
+        if cache is not None:
+            for hashData, sampleData in searchData.items():
+                cache.put_sample(hashData, sampleData)
+        return searchData
     except Exception as e:
-        print(f"Unable to get sample data--ERROR: {e}")
+        print(f"Unable to get batch sample data for {len(searchList)} hashes--ERROR: {e}")
+        journal.reset(queryTag, searchList)
+        # smaller searches finish sooner, but no search goes through once the points are gone
+        if splits <= 0 or len(searchList) < 2 or isinstance(e, PointsExhausted):
+            return {}
+
+    half = len(searchList) // 2
+    searchData, otherData = await asyncio.gather(
+        searchSplit(hostname, apiKey, searchList[:half], hashType, queryTag, splits - 1),
+        searchSplit(hostname, apiKey, searchList[half:], hashType, queryTag, splits - 1))
+    searchData.update(otherData)
+    return searchData
+
+
+async def searchBatch(batchList, queryTag, hashType, apiKey, bypassCache=False):
+    """
+    search stage of a run: the sample data of a batch of hashes, using one batched
+    search for those not already cached, as getSampleInfo work for the coverage stage
+    hashes a failed batched search could not find are passed on as failed, not searched one at a time
+    runs on the Autofocus client's event loop, the journal and cache calls are short sqlite
+    statements made in place while network waits are awaited
+    """
+
+    if len(batchList) == 1:
+        return [await getSampleInfo(batchList[0], queryTag, apiKey, bypassCache=bypassCache)]
+
+    hostname = get_af_host()
+    cache = get_cache()
+    journal = get_journal()
+    batchData = {}
+    if cache is not None and not bypassCache:
+        for hashData in batchList:
+            sampleData = cache.get_sample(hashData)
+            if sampleData is not None:
+                batchData[hashData] = sampleData
+
+    # hashes of a resumed run poll the batch search they were already part of
+    searchList = []
+    resumedSearches = {}
+    for hashData in batchList:
+        if hashData in batchData:
+            continue
+        entry = journal.get_entry(queryTag, hashData)
+        if entry.state == SEARCHED and entry.cookie:
+            resumedSearches.setdefault(entry.cookie, []).append(hashData)
+        elif entry.state == QUEUED:
+            searchList.append(hashData)
+
+    for cookie, cookieList in resumedSearches.items():
+        try:
+            batchData.update(await get_batch_sample_data(hostname, apiKey, cookieList,
+                                                         hashType, {'af_cookie': cookie}))
+        except Exception as e:
+            print(f"Unable to resume batch search {cookie}--ERROR: {e}")
+            journal.reset(queryTag, cookieList)
+            searchList.extend(cookieList)
+
+    # hashes another job is searching right now wait for its answer instead of going in this search
+    inflight = get_inflight()
+    waiting = {}
+    claimed = []
+    for hashData in searchList:
+        future, leader = inflight.claim(('sample', hashData), use_memo=not bypassCache)
+        if leader:
+            claimed.append(hashData)
+        else:
+            waiting[hashData] = future
+    searchList = claimed
+
+    try:
+        if len(searchList) > 1:
+            batchData.update(await searchSplit(hostname, apiKey, searchList, hashType, queryTag,
+                                               max(get_config_int('TORT_BATCH_SPLITS', 1), 0)))
+        elif searchList:
+            hashData = searchList[0]
+            try:
+                batchData[hashData] = await searchHash(hostname, apiKey, hashData, hash_type(hashData) or "MD5",
+                                                       queryTag, journal.get_entry(queryTag, hashData), bypassCache)
+                if cache is not None:
+                    cache.put_sample(hashData, batchData[hashData])
+            except Exception as e:
+                print(f"Unable to get sample data--ERROR: {e}")
+    finally:
+        # hashes missing here failed, their waiters search them again themselves
+        for hashData in searchList:
+            if hashData in batchData:
+                inflight.resolve(('sample', hashData), batchData[hashData])
+            else:
+                inflight.fail(('sample', hashData), AutofocusError(f"Search for {hashData} failed in another run"))
+
+    for hashData, future in waiting.items():
+        try:
+            batchData[hashData] = await inflight.wait_async(future)
+        except Exception as e:
+            print(f"Shared search for {hashData} failed, searching it again--ERROR: {e}")
+
+    # hashes this batch searched and did not find failed, empty sample data stores them as failed
+    failed = set(searchList) - set(batchData)
+    return [(hashData, HashRecord(), None) if hashData in failed
+            else await getSampleInfo(hashData, queryTag, apiKey, batchData.get(hashData), bypassCache)
+            for hashData in batchList]
+
+
+async def lookupSample(hostname, apiKey, thisHash, hashType, searchDict, bypassCache=False):
+    """ read the sample data of a posted search, taking the fast path for SHA256 hashes """
+
+    if hashType == 'SHA256':
+        return await get_sha256_sample_data(hostname, apiKey, thisHash, searchDict, bypassCache)
+
+    return await get_sample_data(hostname, apiKey, thisHash, hashType, searchDict)
+
+
+async def searchHash(hostname, apiKey, thisHash, hashType, queryTag, journalEntry, bypassCache=False):
+    """
+    search Autofocus for one hash, recording its search cookie in the run journal
+    a cookie saved by an earlier attempt of the run is polled instead of searching again
+    """
+
+    journal = get_journal()
+
+    if journalEntry.state == SEARCHED and journalEntry.cookie:
+        try:
+            return await lookupSample(hostname, apiKey, thisHash, hashType, {'af_cookie': journalEntry.cookie},
+                                      bypassCache)
+        except AutofocusError as e:
+            print(f"Unable to resume search {journalEntry.cookie}, searching again--ERROR: {e}")
+
+    searchDict = await init_query(hostname, apiKey, thisHash)
+    journal.searched(queryTag, [thisHash], searchDict['af_cookie'])
+
+    return await lookupSample(hostname, apiKey, thisHash, hashType, searchDict, bypassCache)
+
+
+async def getSampleInfo(thisHash, queryTag, apiKey, sampleData=None, bypassCache=False):
+    """
+    search stage of one hash, returns the work for getCoverageInfo: (hash, sample data, record)
+    record is the finished record of a hash covered by an earlier attempt of the run
+    """
+
+    hostname = get_af_host()
+    hashType = hash_type(thisHash) or "MD5"
+
+    # a hash covered by an earlier attempt of this run only needs storing
+    journal = get_journal()
+    journalEntry = journal.get_entry(queryTag, thisHash)
+    if journalEntry.state == COVERED and journalEntry.record:
+        return thisHash, None, journalEntry.record
+
+    # bypassCache skips reading the cache for this run, fresh results are still cached
+    cache = get_cache()
+
+    # query Autofocus to get sample data unless a batched search or the cache already returned it
+    if sampleData is None and cache is not None and not bypassCache:
+        sampleData = cache.get_sample(thisHash)
+
+    if sampleData is None:
+        sampleData = HashRecord()
+        try:
+            # a search of the same hash from another job is shared instead of sent again
+            sampleData = await get_inflight().do_async(('sample', thisHash),
+                                                       partial(searchHash, hostname, apiKey, thisHash, hashType,
+                                                               queryTag, journalEntry, bypassCache),
+                                                       use_memo=not bypassCache)
+            if cache is not None:
+                cache.put_sample(thisHash, sampleData)
+        except Exception as e:
+            print(f"Unable to get sample data--ERROR: {e}")
+
+    return thisHash, sampleData, None
+
+
+def getCoverageInfo(work, queryTag, apiKey, bypassCache=False):
+    """ coverage stage of one hash: add the signature coverage to the getSampleInfo sample data """
+
+    thisHash, sampleData, record = work
+    if record is not None:
+        return record
+
+    hostname = get_af_host()
+    now = datetime.datetime.now().replace(microsecond=0).isoformat('T')
+    hashDataDict = HashRecord()
+    complete = False
+
+    cache = get_cache()
+    readCache = cache is not None and not bypassCache
 
     try:
         if sampleData['verdict'] != 'No sample found':
-            hashDataDict, hashCounters = \
-                get_sig_coverage(hostname, apiKey, sampleData, hashCounters)
+            coverage = None
+            if 'wf_av_sig' not in sampleData and readCache:
+                coverage = cache.get_coverage(thisHash)
+
+            if 'wf_av_sig' in sampleData:
+                # the SHA256 fast path fetched the coverage with the search
+                hashDataDict = sampleData
+                if cache is not None:
+                    cache.put_coverage(thisHash, hashDataDict)
+            elif coverage is not None:
+                hashDataDict = add_coverage(sampleData, coverage)
+            else:
+                hashDataDict = get_sig_coverage(hostname, apiKey, sampleData, bypassCache)
+                if cache is not None:
+                    cache.put_coverage(thisHash, hashDataDict)
+        else:
+            hashDataDict = sampleData
+        complete = True
     except Exception as e:
         print(e)
 
     # Add some pertinent info to the data before saving
+    hashDataDict.setdefault('hashvalue', thisHash)
     hashDataDict['query_time'] = now
     hashDataDict['query_tag'] = queryTag
 
-    if 'text' in outputType:
-        return hashDataDict
-    else:
-        try:
-            result = helpers.bulk(es, loadJSON(hashDataDict))
-            print(f"Result of indexing {thisHash} "
-                  f"is {result}")
-            if result[0] == 1:
-                return {thisHash: "SUCCESS"}
-            else:
-                return {thisHash: "FAILURE"}
-        except Exception as e:
-            return {thisHash: f"Unknown error {e}"}
+    if complete:
+        get_journal().covered(queryTag, thisHash, hashDataDict)
+
+    return hashDataDict
+
+
+def getHashInfo(thisHash, outputType, queryTag, apiKey, sampleData=None, bypassCache=False):
+    """ look up one hash start to finish, the search and coverage stages back to back """
+
+    return getCoverageInfo(run_coroutine(getSampleInfo(thisHash, queryTag, apiKey, sampleData, bypassCache)),
+                           queryTag, apiKey, bypassCache)
+
+
+def read_results(outFile):
+    """ formatted text of a results file for the results page """
+
+    return "".join(json.dumps(record, indent=4, sort_keys=False) + "\n"
+                   for record in iter_results(outFile))
 
 
-def process_hashes(payload):
+def read_results_page(outFile, page=1, pageSize=100):
+    """
+    formatted text of one page of a results file plus the number of records in the file,
+    reading a record at a time so only the page is held in memory
+    """
+
+    start = (page - 1) * pageSize
+    lines = []
+    total = 0
+    for record in iter_results(outFile):
+        if start <= total < start + pageSize:
+            lines.append(json.dumps(record, indent=4, sort_keys=False) + "\n")
+        total += 1
+
+    return "".join(lines), total
+
+
+def process_hashes(payload, progress=None, readResults=True):
     '''
     Requires a JSON formatted payload with the following keys:
     queryTag - name of search so you can query it later in Kibana
-    hashes - Comma delimited list of hashes to go get info on
-        
+    hashes - list of hashes to go get info on, delimited by newlines, commas or whitespace
+    hash_file - optionally the path of an uploaded file of hashes, read a line at a time instead of hashes
+
+    progress is passed on to processHashList, with readResults False the
+    results file name is returned instead of its contents
+
     :return: formatted file to display in AFrame UI
-        HTTP-400 if required API key is missing - this comes from config
-        HTTP-500 on application error
+    :raises TortError: with the message to show when the API key or the hashes are missing
+        or the run failed, so a background job ends in FAILURE instead of returning it
     '''
     init_application()
 
     try:
         postedJSON = payload
-        print(f"Received the following JSON: {postedJSON}")
+        # the API keys never go into logs or job results
+        loggedJSON = {key: value for key, value in postedJSON.items() if key != 'api_key'}
+        print(f"Received the following JSON: {loggedJSON}")
         queryTag = postedJSON['query_tag']
-        hashListString = postedJSON['hashes']
+        hashListString = postedJSON.get('hashes') or ''
         outputType = postedJSON['output_type']
-        apiKey = postedJSON.get('api_key', '')
+        apiKey = postedJSON.get('api_key') or ''
+        bypassCache = str(postedJSON.get('bypass_cache', 'no')).lower() in ('yes', 'true', '1')
         hashType = 'MD5'  # postedJSON['hash_type']
         if apiKey == "":
             apiKey = cnc_utils.get_config_value("AUTOFOCUS_API_KEY", "NOT-SET")
-        if apiKey == "NOT-SET":
-            return ("There is no API key set in .panrc and there wasn't one entered")
-        # hash should have newlines replaced by HTML char for newline '%0A', 
-        # let's split on that here to get a list
-        # could also check for ',' and split on that too if necessary
-        if len(hashListString) == 32:
-            # this is a single entry instead of a list!
-            hashList = list()
-            hashList.append(hashListString)
-        elif '%0A' in hashListString:
-            hashList = hashListString.strip('%0A').split('%0A')
-        elif ',' in hashListString:
-            hashList = hashListString.split(',')
-        elif '\\n' in hashListString:
-            # it's something else like
-            hashList = hashListString.split('\\n')
-        elif '\r\n' in hashListString:
-            # it's something else like
-            hashList = hashListString.split('\r\n')
+        if apiKey == "NOT-SET" or not split_keys(apiKey):
+            raise TortError("There is no API key set in .panrc and there wasn't one entered")
+        # several keys, separated by commas or whitespace, share the run's Autofocus requests
+        apiKey = ",".join(split_keys(apiKey))
+        print(f"Using {len(split_keys(apiKey))} Autofocus API key(s)")
+        # hashes come pasted in the form or as an uploaded file, delimited by any mix of
+        # newlines, '%0A', commas or whitespace; invalid and duplicate hashes are dropped
+        parser = HashParser()
+        if postedJSON.get('hash_file'):
+            hashList = list(get_hash_list(postedJSON['hash_file'], parser))
         else:
-            return 'Could not parse JSON payload ' + str(postedJSON)
+            hashList = list(parser.parse(hashListString))
+        print(f"Hash list parsed: {parser.summary()}")
+        if parser.rejects:
+            print(f"Rejected hash list entries: {parser.rejects}")
+        if not hashList:
+            raise TortError('Could not find any MD5, SHA1 or SHA256 hashes in ' + str(loggedJSON))
+
+        if progress is not None:
+            reportProgress = progress
 
-        # now we should have a valid hash list to work with
-        print(f"Hash list is {hashList}")
+            def progress(runProgress):
+                reportProgress(dict(runProgress, rejected=len(parser.rejects), duplicates=parser.duplicates))
 
         if "text" in outputType:
-            outFile = processHashList(hashList, outputType, queryTag, hashType, apiKey)
+            outFile = processHashList(hashList, outputType, queryTag, hashType, apiKey, bypassCache, progress)
+            if not readResults:
+                return outFile
             path, fileName = os.path.split(f"{outFile}")
             print(f"returning fileName is {fileName}")
             print(f"path is {path}")
-            with open(outFile, "r") as myFile:
-                return myFile.read()
+            return read_results(outFile)
         else:
-            hashListResult = processHashList(hashList, outputType, queryTag, hashType, apiKey)
+            hashListResult = processHashList(hashList, outputType, queryTag, hashType, apiKey, bypassCache, progress)
             print(f"{hashListResult}")
             # return render_template('kibana_page.html',list=hashListResult)
+            return hashListResult
 
 
 
+    except TortError as te:
+        print(te)
+        raise
+    except RunInProgress as rip:
+        print(rip)
+        raise TortError(str(rip)) from rip
     except KeyError as ke:
         print(ke)
-        return ke
+        raise TortError(f"The submitted form is missing {ke}") from ke
     except Exception as e:
         print(e)
         errorMessage = f"Problem with query to Autofocus: {e}"
-        # abort(501, {'message': errorMessage})
-        # abort(501, {'message': f'Problem with query to Autofocus {e}'})
+        raise TortError(errorMessage) from e
 
 
 # @app.before_first_request
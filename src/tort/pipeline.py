@@ -0,0 +1,193 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Staged pipeline for TORT runs
+
+Each stage has its own pool of worker threads and hands its output to the
+next stage through a bounded queue. A slow stage fills its input queue and
+holds back the stages before it, while the stages after it keep working on
+what is already done, so a run takes about as long as its slowest stage.
+
+A stage given an event loop runs its func as a coroutine on that loop
+instead: one thread submits items to the loop and up to workers of them
+are in flight at the same time, so a stage waiting on the network holds
+a slot per outstanding request rather than a thread.
+
+'''
+
+import asyncio
+import queue
+import threading
+from functools import partial
+
+_DONE = object()
+
+
+class Stage:
+    """
+    one step of a pipeline: func takes an item and returns an iterable of
+    items for the next stage, run on workers threads
+    on_error(item, error) returns the items to pass on when func raises, so a
+    failed item still comes out of the pipeline instead of going missing
+    with loop, func is a coroutine function run on that event loop, workers items at a time
+    """
+
+    def __init__(self, name, func, workers=1, on_error=None, loop=None):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.on_error = on_error
+        self.loop = loop
+
+    @property
+    def threads(self):
+        """ threads taking items from the stage's input, one for a coroutine stage """
+
+        return 1 if self.loop is not None else self.workers
+
+
+class Pipeline:
+    """ runs items through stages connected by queues of queue_size items """
+
+    def __init__(self, stages, queue_size=100):
+        self.stages = stages
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+
+    def _put(self, item_queue, item):
+        while not self._stop.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _feed(self, items, out_queue, consumers):
+        try:
+            for item in items:
+                if self._stop.is_set():
+                    return
+                self._put(out_queue, item)
+        finally:
+            for _ in range(consumers):
+                self._put(out_queue, _DONE)
+
+    def _get(self, item_queue):
+        while not self._stop.is_set():
+            try:
+                return item_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _acquire(self, slots):
+        while not self._stop.is_set():
+            if slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _hand_on(self, stage, item, result, out_queue):
+        try:
+            out_items = list(result())
+        except Exception as e:
+            print(f"Pipeline stage {stage.name} failed on {item}--ERROR: {e}")
+            out_items = list(stage.on_error(item, e)) if stage.on_error is not None else []
+        for out_item in out_items:
+            self._put(out_queue, out_item)
+
+    def _work(self, stage, in_queue, out_queue):
+        # workers give up once the pipeline is stopped, so a failed run leaves no threads behind
+        while True:
+            item = self._get(in_queue)
+            if item is _DONE:
+                return
+            self._hand_on(stage, item, partial(stage.func, item), out_queue)
+
+    def _drive(self, stage, in_queue, out_queue):
+        # a slot is taken for every item submitted to the loop and given back once its items are
+        # handed on, so holding every slot after the last item means the stage is done
+        slots = threading.BoundedSemaphore(stage.workers)
+        finished = queue.Queue()
+        running = set()
+        collector = self._start(self._collect, (stage, finished, out_queue, slots),
+                                f'pipeline-{stage.name}-collect')
+
+        def done(item, future):
+            running.discard(future)
+            finished.put((item, future))
+
+        try:
+            while self._acquire(slots):
+                item = self._get(in_queue)
+                if item is _DONE:
+                    for _ in range(stage.workers - 1):
+                        if not self._acquire(slots):
+                            break
+                    return
+                future = asyncio.run_coroutine_threadsafe(stage.func(item), stage.loop)
+                running.add(future)
+                future.add_done_callback(partial(done, item))
+        finally:
+            for future in list(running):
+                future.cancel()
+            finished.put(_DONE)
+            collector.join()
+
+    def _collect(self, stage, finished, out_queue, slots):
+        while True:
+            entry = self._get(finished)
+            if entry is _DONE:
+                return
+            item, future = entry
+            self._hand_on(stage, item, future.result, out_queue)
+            slots.release()
+
+    def _close(self, workers, out_queue, consumers):
+        for worker in workers:
+            worker.join()
+        for _ in range(consumers):
+            self._put(out_queue, _DONE)
+
+    def _start(self, target, args, name):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, items):
+        """ feed items into the first stage and yield what comes out of the last one """
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        consumers = [stage.threads for stage in self.stages] + [1]
+
+        self._start(self._feed, (items, queues[0], consumers[0]), 'pipeline-feed')
+
+        for index, stage in enumerate(self.stages):
+            work = self._drive if stage.loop is not None else self._work
+            workers = [self._start(work, (stage, queues[index], queues[index + 1]),
+                                   f'pipeline-{stage.name}-{number}')
+                       for number in range(stage.threads)]
+            self._start(self._close, (workers, queues[index + 1], consumers[index + 1]),
+                        f'pipeline-{stage.name}-close')
+
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            self._stop.set()
@@ -0,0 +1,105 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Autofocus points budget of an API key
+
+Every Autofocus API call costs points out of a per minute and a per day
+bucket. PointsLimiter is a token bucket refilled at the minute rate and
+capped by the daily total so concurrent workers never overdraw either one.
+The daily bucket starts over at midnight UTC, when Autofocus resets it.
+The key pool in key_pool keeps one limiter per API key.
+
+'''
+
+import datetime
+import threading
+import time
+
+
+class PointsExhausted(Exception):
+    """ raised when the daily Autofocus points budget is used up """
+    pass
+
+
+class PointsLimiter:
+    """
+    token bucket sized in Autofocus points per minute and per day
+    a limit of 0 means that bucket is not enforced
+    """
+
+    def __init__(self, minute_points, daily_points):
+        self.minute_points = minute_points
+        self.daily_points = daily_points
+        self._lock = threading.Lock()
+        self._tokens = float(minute_points)
+        self._refill_time = time.monotonic()
+        self._day = datetime.datetime.utcnow().date()
+        self._day_used = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(float(self.minute_points),
+                           self._tokens + (now - self._refill_time) * self.minute_points / 60.0)
+        self._refill_time = now
+
+        today = datetime.datetime.utcnow().date()
+        if today != self._day:
+            self._day = today
+            self._day_used = 0
+
+    def reserve(self, points=1):
+        """
+        take points from the buckets if they are there and return 0, otherwise
+        return the seconds to wait before trying again; raise if the day is used up
+        """
+
+        with self._lock:
+            self._refill()
+
+            if self.daily_points and self._day_used + points > self.daily_points:
+                raise PointsExhausted(f"Daily Autofocus points budget of {self.daily_points} used up")
+
+            if not self.minute_points or self._tokens >= points:
+                self._tokens -= points
+                self._day_used += points
+                return 0
+
+            return (points - self._tokens) * 60.0 / self.minute_points
+
+    def sync(self, minute_remaining=None, daily_remaining=None):
+        """
+        line the buckets up with the points Autofocus reports left, which also
+        counts what other users of the same API key spent
+        the daily points left are taken as they are, so a reset Autofocus saw
+        before this limiter's day turned over frees the daily bucket right away
+        """
+
+        with self._lock:
+            self._refill()
+            if minute_remaining is not None and self.minute_points:
+                self._tokens = min(self._tokens, float(minute_remaining))
+            if daily_remaining is not None and self.daily_points:
+                self._day_used = max(self.daily_points - daily_remaining, 0)
+
+    def remaining(self):
+        """ points left in the minute and daily buckets """
+
+        with self._lock:
+            self._refill()
+            return {'minute_points': int(self._tokens) if self.minute_points else None,
+                    'daily_points': self.daily_points - self._day_used if self.daily_points else None}
+
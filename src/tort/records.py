@@ -0,0 +1,156 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Hash result records and their serialization
+
+HashRecord holds the result of one hash in fixed slots instead of a dict,
+which keeps 100k hash runs small in memory. It still reads and writes like
+the hash_data_dict it replaces, so record['verdict'] and 'wf_av_sig' in
+record keep working. Fields that were never set are left out of the
+record's JSON.
+
+dumps and loads are the one JSON path for results, the cache and the run
+journal. They use orjson or ujson when either is installed and the
+standard library json module otherwise.
+
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# where the result of a hash came from, the source field of its record
+SOURCE_AUTOFOCUS = 'autofocus'
+SOURCE_CACHE = 'cache'
+
+
+class HashRecord:
+    """ the result of one hash, fields in the order they are written out """
+
+    __slots__ = ('hashtype', 'hashvalue', 'verdict', 'filetype', 'sha256hash', 'create_date', 'tag',
+                 'dns_sig', 'wf_av_sig', 'fileurl_sig', 'coverage_status', 'query_time', 'query_tag', 'source')
+
+    def __init__(self, **fields):
+        for field, value in fields.items():
+            self[field] = value
+
+    @classmethod
+    def from_dict(cls, hash_data_dict):
+        """ record from a dict read back from the cache, journal or a results file, unknown keys are dropped """
+
+        if isinstance(hash_data_dict, cls):
+            return hash_data_dict
+
+        record = cls()
+        for field in cls.__slots__:
+            if field in hash_data_dict:
+                setattr(record, field, hash_data_dict[field])
+        return record
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        try:
+            setattr(self, field, value)
+        except AttributeError:
+            raise KeyError(f"{field} is not a hash record field")
+
+    def __contains__(self, field):
+        return field in self.__slots__ and hasattr(self, field)
+
+    def __eq__(self, other):
+        if isinstance(other, (HashRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"HashRecord({self.to_dict()})"
+
+    def get(self, field, default=None):
+        return getattr(self, field, default) if field in self.__slots__ else default
+
+    def setdefault(self, field, default=None):
+        if field not in self:
+            self[field] = default
+        return self[field]
+
+    def update(self, fields):
+        for field, value in fields.items():
+            self[field] = value
+
+    def keys(self):
+        return [field for field in self.__slots__ if hasattr(self, field)]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.__slots__ if hasattr(self, field)]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def copy(self):
+        """ shallow copy, setting a field of the copy leaves this record alone """
+
+        record = HashRecord()
+        for field, value in self.items():
+            setattr(record, field, value)
+        return record
+
+
+def as_dict(record):
+    """ plain dict of a HashRecord, anything else is returned as is """
+
+    return record.to_dict() if isinstance(record, HashRecord) else record
+
+
+def copy_record(record):
+    """ a copy of a HashRecord, anything else is returned as is """
+
+    return record.copy() if isinstance(record, HashRecord) else record
+
+
+def dumps(record):
+    """ compact JSON text of a record or any other JSON value """
+
+    record = as_dict(record)
+
+    if orjson is not None:
+        return orjson.dumps(record).decode('utf-8')
+    if ujson is not None:
+        return ujson.dumps(record, escape_forward_slashes=False)
+
+    return json.dumps(record, separators=(',', ':'))
+
+
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    if ujson is not None:
+        return ujson.loads(text)
+
+    return json.loads(text)
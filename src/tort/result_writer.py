@@ -0,0 +1,186 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Text output for TORT runs
+
+ResultWriter keeps one buffered handle open for the whole run and writes
+each hash as a line of compact JSON (NDJSON), optionally gzip compressed.
+iter_results reads a results file back one hash at a time and ResultsTail
+follows one while its run is still writing it. compact_results trims the
+results file of a resumed run down to the hashes it already stored.
+
+'''
+
+import gzip
+import os
+import threading
+import time
+import zlib
+
+from .config import get_config_float, get_config_int
+from .metrics import metrics
+from .records import dumps, loads
+
+
+class ResultWriter:
+    """
+    append hash results to path as NDJSON, gzip compressed when path ends in .gz
+    the buffer is flushed once flush_bytes are waiting or flush_interval seconds have passed
+    on_flush is called with the hashvalues of the records each flush put on disk
+    """
+
+    def __init__(self, path, flush_bytes=None, flush_interval=None, on_flush=None):
+        self.path = path
+        self.on_flush = on_flush
+        self.flush_bytes = flush_bytes or get_config_int('TORT_OUTPUT_FLUSH_BYTES', 1024 * 1024)
+        self.flush_interval = flush_interval or get_config_float('TORT_OUTPUT_FLUSH_INTERVAL', 5)
+        self.count = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._pending_keys = []
+        self._last_flush = time.monotonic()
+
+        if path.endswith('.gz'):
+            self._file = gzip.open(path, 'at', encoding='utf-8')
+        else:
+            self._file = open(path, 'a', buffering=self.flush_bytes, encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def format_record(self, record):
+        """ text written for one record """
+
+        return dumps(record) + "\n"
+
+    def write(self, record):
+        line = self.format_record(record)
+
+        with self._lock:
+            self._file.write(line)
+            self.count += 1
+            self._pending += len(line)
+            self._pending_keys.append(record.get('hashvalue'))
+            if self._pending >= self.flush_bytes or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        with metrics.time_stage('file_flush'):
+            self._file.flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+        keys, self._pending_keys = self._pending_keys, []
+        if self.on_flush is not None and keys:
+            self.on_flush(keys)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._flush()
+                self._file.close()
+
+
+def open_results(path):
+    """ text handle on a results file, plain or gzip compressed """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+
+    return open(path, 'r', encoding='utf-8')
+
+
+def iter_results(path):
+    """ yield the hash results in a results file one at a time """
+
+    with open_results(path) as results_file:
+        for line in results_file:
+            if line.strip():
+                yield loads(line)
+
+
+def compact_results(path, keep):
+    """
+    rewrite a results file with only the last record of each hash in keep and return how many are left
+    records of failed or unfinished hashes go, since a resumed run searches those again
+    """
+
+    last = {}
+    for number, record in enumerate(iter_results(path)):
+        if record.get('hashvalue') in keep:
+            last[record['hashvalue']] = number
+
+    lines = set(last.values())
+    tmp_path = f"{path}.tmp.gz" if path.endswith('.gz') else f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with ResultWriter(tmp_path) as writer:
+        for number, record in enumerate(iter_results(path)):
+            if number in lines:
+                writer.write(record)
+    os.replace(tmp_path, path)
+
+    return len(lines)
+
+
+class ResultsTail:
+    """
+    follow a results file as its run writes it, each read picks up the complete lines written since the last one
+    gzip files are decompressed as they grow, a resumed run appends another gzip member
+    """
+
+    def __init__(self, path, chunk_size=64 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._offset = 0
+        self._pending = b''
+        self._gzip = path.endswith('.gz')
+        self._decompress = zlib.decompressobj(zlib.MAX_WBITS | 16) if self._gzip else None
+
+    def _gunzip(self, chunk):
+        data = self._decompress.decompress(chunk)
+        while self._decompress.eof and self._decompress.unused_data:
+            rest = self._decompress.unused_data
+            self._decompress = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            data += self._decompress.decompress(rest)
+        return data
+
+    def read(self):
+        """ yield the hash results written since the last read, a chunk at a time """
+
+        with open(self.path, 'rb') as results_file:
+            results_file.seek(self._offset)
+            while True:
+                chunk = results_file.read(self.chunk_size)
+                if not chunk:
+                    return
+                self._offset += len(chunk)
+
+                lines = (self._pending + (self._gunzip(chunk) if self._gzip else chunk)).split(b'\n')
+                self._pending = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        self.count += 1
+                        yield loads(line)
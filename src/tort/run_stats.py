@@ -0,0 +1,186 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Run statistics
+
+RunStats tallies every stored hash of a run: verdicts, signature coverage
+of malware overall and per signature type, no sample found, filetypes and
+tags. The stats file next to the results is rewritten every
+TORT_STATS_FLUSH_INTERVAL seconds and at the end of the run, and the
+latest snapshot travels with the run progress so the job status shows the
+summary while the run is going. A resumed run counts its results file
+again, since the stats file can be up to one flush behind it.
+
+'''
+
+import collections
+import json
+import os
+import threading
+import time
+
+from .config import get_config_float
+from .coverage import ACTIVE, INACTIVE, NO_SIG, SIG_TYPES, coverage_breakdown
+from .result_writer import iter_results
+
+# hash counter of a malware sample by its coverage status
+MALWARE_COVERAGE = {ACTIVE: 'mal_active_sig', INACTIVE: 'mal_inactive_sig', NO_SIG: 'mal_no_sig'}
+
+
+def init_hash_counters():
+    """
+    Use counters to create a simple output stats file in tandem with json details
+    Initialize counters to zero
+    """
+
+    hash_counters = {}
+    hash_count_values = ['total samples', 'malware', 'mal_inactive_sig', 'mal_active_sig',
+                         'mal_no_sig', 'grayware', 'benign', 'phishing', 'No sample found', 'failed']
+
+    for value in hash_count_values:
+        hash_counters[value] = 0
+
+    return hash_counters
+
+
+def stats_path(out_file):
+    """ stats file of a run, next to its results file """
+
+    for extension in ('.gz', '.ndjson'):
+        if out_file.endswith(extension):
+            out_file = out_file[:-len(extension)]
+
+    return f"{out_file}.stats.json"
+
+
+class RunStats:
+    """
+    thread safe run wide tallies written to path every flush_interval seconds
+    a resumed run recounts the records of results_file, or picks up the tallies
+    of its stats file when it has no results file
+    """
+
+    def __init__(self, path, resume=False, flush_interval=None, results_file=None):
+        self.path = path
+        self.flush_interval = flush_interval or get_config_float('TORT_STATS_FLUSH_INTERVAL', 5)
+        self.counters = init_hash_counters()
+        self.filetypes = collections.Counter()
+        self.tags = collections.Counter()
+        self.signature_types = {sig_type: {ACTIVE: 0, INACTIVE: 0, NO_SIG: 0} for sig_type in SIG_TYPES}
+        self.latest = None
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        if resume and results_file is not None and os.path.exists(results_file):
+            self._recount(results_file)
+        elif resume and os.path.exists(path):
+            self._load()
+
+    def _recount(self, results_file):
+        for hash_data_dict in iter_results(results_file):
+            self._count(hash_data_dict)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as stats_file:
+                saved = json.load(stats_file)
+        except ValueError as e:
+            print(f"Unable to read run stats {self.path}, starting over--ERROR: {e}")
+            return
+
+        self.counters.update(saved.get('counters', {}))
+        self.filetypes.update(saved.get('filetypes', {}))
+        self.tags.update(saved.get('tags', {}))
+        for sig_type, counts in saved.get('signature_types', {}).items():
+            self.signature_types.setdefault(sig_type, {}).update(counts)
+
+    def write(self, hash_data_dict):
+        """ count one stored hash """
+
+        with self._lock:
+            self._count(hash_data_dict)
+
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def _count(self, hash_data_dict):
+        verdict = hash_data_dict.get('verdict')
+
+        self.counters['total samples'] += 1
+        if verdict is None:
+            self.counters['failed'] += 1
+        else:
+            self.counters[verdict] = self.counters.get(verdict, 0) + 1
+        if verdict == 'malware':
+            self._add_coverage(hash_data_dict)
+        if 'filetype' in hash_data_dict:
+            self.filetypes[hash_data_dict['filetype']] += 1
+        self.tags.update(hash_data_dict.get('tag') or [])
+
+    def _add_coverage(self, hash_data_dict):
+        """ count a malware sample as active, inactive or no sig, overall and per signature type """
+
+        best = NO_SIG
+        for sig_type, counts in coverage_breakdown(hash_data_dict).items():
+            status = ACTIVE if counts[ACTIVE] else INACTIVE if counts[INACTIVE] else NO_SIG
+            self.signature_types[sig_type][status] += 1
+            if status == ACTIVE or (status == INACTIVE and best == NO_SIG):
+                best = status
+
+        self.counters[MALWARE_COVERAGE[best]] += 1
+
+    def _snapshot(self):
+        return {'counters': dict(self.counters),
+                'signature_types': {sig_type: dict(counts) for sig_type, counts in self.signature_types.items()},
+                'filetypes': dict(self.filetypes.most_common()),
+                'tags': dict(self.tags.most_common())}
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _flush(self):
+        self.latest = self._snapshot()
+        self._last_flush = time.monotonic()
+
+        # write a new file and swap it in so readers never see a half written one
+        try:
+            with open(f"{self.path}.tmp", 'w') as stats_file:
+                json.dump(self.latest, stats_file, indent=4, sort_keys=False)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            print(f"Unable to write run stats {self.path}--ERROR: {e}")
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """ final flush, returning the stats of the run """
+
+        self.flush()
+        return self.latest
+
+
+def read_stats(path):
+    """ stats written by a RunStats, None if there are none """
+
+    try:
+        with open(path, 'r') as stats_file:
+            return json.load(stats_file)
+    except (OSError, ValueError):
+        return None
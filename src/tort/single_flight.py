@@ -0,0 +1,175 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Single flight Autofocus lookups across jobs
+
+Jobs running at the same time often look up the same hashes. SingleFlight
+lets the first job to ask for a hash or a sample's coverage run the lookup
+while every later job waits on the same future, then keeps the answer for
+TORT_INFLIGHT_MEMO_SECONDS so jobs asking right after it finished are
+served too. Each Autofocus query for a hash is then paid for once no
+matter how many jobs want it.
+
+'''
+
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import Future
+
+from .config import get_config_float, get_config_int
+from .metrics import metrics
+from .records import copy_record
+
+
+class SingleFlight:
+    """
+    process wide registry of lookups in flight, by key, plus a short lived memo of finished ones
+    copy is applied to every shared value so no two callers mutate the same one
+    """
+
+    def __init__(self, memo_seconds, max_memo=10000, copy=None):
+        self.memo_seconds = memo_seconds
+        self.max_memo = max_memo
+        self.copy = copy or (lambda value: value)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        # key -> (expiry, value), oldest first since every entry lives as long
+        self._memo = collections.OrderedDict()
+
+    def _expire(self, now):
+        while self._memo and (len(self._memo) > self.max_memo or next(iter(self._memo.values()))[0] <= now):
+            self._memo.popitem(last=False)
+
+    def claim(self, key, use_memo=True):
+        """
+        (future, True) when the caller leads the lookup of key and has to resolve or fail it,
+        otherwise (future, False) with the lookup another caller runs or the memoized answer
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            if use_memo and key in self._memo:
+                future = Future()
+                future.set_result(self._memo[key][1])
+                metrics.observe_coalesced('memo')
+                return future, False
+
+            if key in self._inflight:
+                metrics.observe_coalesced('inflight')
+                return self._inflight[key], False
+
+            future = self._inflight[key] = Future()
+            return future, True
+
+    def resolve(self, key, value):
+        """ finish the lookup of key, waiters and the memo get a copy of value """
+
+        shared = self.copy(value)
+        with self._lock:
+            future = self._inflight.pop(key, None)
+            if self.memo_seconds > 0:
+                self._memo.pop(key, None)
+                self._memo[key] = (time.monotonic() + self.memo_seconds, shared)
+        if future is not None:
+            future.set_result(shared)
+
+    def fail(self, key, error):
+        """ fail the lookup of key for its waiters, failures are not memoized """
+
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_exception(error)
+
+    def wait(self, future):
+        """ the value of a lookup claimed by another caller, copied for this one """
+
+        return self.copy(future.result())
+
+    def do(self, key, lookup, use_memo=True):
+        """
+        the value of lookup() for key, run here unless it is already running or memoized
+        a lookup that failed for another caller is run again here, since errors such as
+        a rejected or used up API key belong to the caller that ran it
+        """
+
+        future, leader = self.claim(key, use_memo)
+        if not leader:
+            try:
+                return self.wait(future)
+            except Exception as e:
+                print(f"Shared lookup of {key} failed, running it again--ERROR: {e}")
+                return lookup()
+
+        try:
+            value = lookup()
+        except Exception as e:
+            self.fail(key, e)
+            raise
+
+        self.resolve(key, value)
+        return value
+
+    async def wait_async(self, future):
+        """ wait as a coroutine, the event loop keeps running other lookups meanwhile """
+
+        return self.copy(await asyncio.wrap_future(future))
+
+    async def do_async(self, key, lookup, use_memo=True):
+        """ do for a coroutine function lookup, waiting on other callers without blocking the event loop """
+
+        future, leader = self.claim(key, use_memo)
+        if not leader:
+            try:
+                return await self.wait_async(future)
+            except Exception as e:
+                print(f"Shared lookup of {key} failed, running it again--ERROR: {e}")
+                return await lookup()
+
+        try:
+            value = await lookup()
+        except Exception as e:
+            self.fail(key, e)
+            raise
+        except BaseException:
+            # a cancelled lookup fails its waiters too, they run it again themselves
+            self.fail(key, Exception(f"Lookup of {key} was cancelled"))
+            raise
+
+        self.resolve(key, value)
+        return value
+
+
+_inflight = None
+_inflight_lock = threading.Lock()
+
+
+def get_inflight():
+    """ process wide SingleFlight for Autofocus lookups, memo sized from the TORT_INFLIGHT_* settings """
+
+    global _inflight
+
+    with _inflight_lock:
+        if _inflight is None:
+            _inflight = SingleFlight(get_config_float('TORT_INFLIGHT_MEMO_SECONDS', 60),
+                                     get_config_int('TORT_INFLIGHT_MEMO_ENTRIES', 10000),
+                                     copy=copy_record)
+        return _inflight
@@ -0,0 +1,182 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Background TORT jobs
+
+tortView submits the hash list as a Celery job and returns right away,
+the job reports its progress through the Celery result backend.
+
+With a real broker in TORT_BROKER_URL run a worker with
+    celery -A tort.tasks worker
+The default memory:// broker runs jobs on a thread of the web process
+instead, which needs no broker or worker for local use and testing.
+
+stream_job follows a job as server-sent events: each hash record once its
+run has stored it, read from the job's results file, and the job progress.
+Elasticsearch output jobs have no results file and stream progress only.
+
+
+'''
+
+import os
+import threading
+import time
+import uuid
+
+from celery import Celery
+from celery.result import AsyncResult
+
+from pan_cnc.lib import cnc_utils
+
+from .config import get_config_float
+from .pan_tort import process_hashes
+from .records import dumps
+from .result_writer import ResultsTail
+from .run_stats import read_stats, stats_path
+
+# seconds between progress updates written to the result backend
+PROGRESS_INTERVAL = 1
+
+FINISHED_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+
+app = Celery('tort',
+             broker=cnc_utils.get_config_value('TORT_BROKER_URL', 'memory://'),
+             backend=cnc_utils.get_config_value('TORT_RESULT_BACKEND', 'cache+memory://'))
+
+
+@app.task(bind=True, name='tort.run_tort_job')
+def run_tort_job(self, payload):
+    """ run process_hashes for a submitted payload, returning the results file or ES results """
+
+    lastUpdate = [0]
+
+    def progress(runProgress):
+        now = time.time()
+        if runProgress['pending'] == 0 or now - lastUpdate[0] >= PROGRESS_INTERVAL:
+            lastUpdate[0] = now
+            self.update_state(state='PROGRESS', meta=dict(runProgress))
+
+    return process_hashes(payload, progress=progress, readResults=False)
+
+
+def is_local_broker():
+    return app.conf.broker_url.startswith('memory://')
+
+
+def _run_local(job_id, payload):
+    """ run the job on this thread and record the outcome in the result backend """
+
+    eager = run_tort_job.apply(args=(payload,), task_id=job_id)
+    if eager.successful():
+        app.backend.mark_as_done(job_id, eager.result)
+    else:
+        app.backend.mark_as_failure(job_id, eager.result, traceback=eager.traceback)
+
+
+def submit_job(payload):
+    """ queue a TORT run and return its job id """
+
+    job_id = str(uuid.uuid4())
+
+    if is_local_broker():
+        threading.Thread(target=_run_local, args=(job_id, payload), name=f'tort-job-{job_id}',
+                         daemon=True).start()
+    else:
+        run_tort_job.apply_async(args=(payload,), task_id=job_id)
+
+    print(f"Submitted TORT job {job_id}")
+    return job_id
+
+
+def get_job_status(job_id):
+    """
+    status of a job with hashes done, pending and failed plus an ETA in seconds
+    and the run stats so far; once the job succeeds result holds the results file or the ES results
+    """
+
+    job = AsyncResult(job_id, app=app)
+    status = {'job_id': job_id, 'status': job.state}
+
+    if job.state == 'PROGRESS' and isinstance(job.info, dict):
+        runProgress = job.info
+        status.update({key: runProgress[key] for key in ('total', 'done', 'failed', 'pending',
+                                                         'rejected', 'duplicates', 'stats', 'out_file')
+                       if key in runProgress})
+        finished = runProgress['done'] + runProgress['failed']
+        if finished:
+            elapsed = time.time() - runProgress['started']
+            status['eta_seconds'] = int(elapsed / finished * runProgress['pending'])
+    elif job.state == 'SUCCESS':
+        status['result'] = job.result
+        if isinstance(job.result, str):
+            status['stats'] = read_stats(stats_path(job.result))
+    elif job.state == 'FAILURE':
+        status['error'] = str(job.result)
+
+    return status
+
+
+def sse_event(event, data):
+    """ one server-sent event with data as JSON """
+
+    return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+
+def stream_job(job_id, poll_interval=PROGRESS_INTERVAL):
+    """
+    server-sent events of a job: a record event per stored hash, a progress event
+    every poll_interval seconds and a done event with the final status
+    records are read from the results file as it grows so none are held in memory
+    celery reports unknown job ids as PENDING, so a job still pending after
+    TORT_STREAM_PENDING_TIMEOUT seconds ends the stream instead of holding it open
+    """
+
+    tail = None
+    pendingTimeout = get_config_float('TORT_STREAM_PENDING_TIMEOUT', 120)
+    started = time.monotonic()
+
+    while True:
+        status = get_job_status(job_id)
+        finished = status['status'] in FINISHED_STATES
+
+        if status['status'] == 'PENDING' and time.monotonic() - started >= pendingTimeout:
+            status['error'] = f"Job {job_id} is unknown or did not start within {pendingTimeout:g} seconds"
+            yield sse_event('done', status)
+            return
+
+        outFile = status.get('out_file')
+        if finished and isinstance(status.get('result'), str):
+            outFile = status['result']
+        if tail is None and outFile and os.path.exists(outFile):
+            tail = ResultsTail(outFile)
+
+        if tail is not None:
+            for record in tail.read():
+                yield sse_event('record', record)
+
+        progress = {key: value for key, value in status.items() if key != 'result'}
+        if tail is not None:
+            progress['streamed'] = tail.count
+
+        if finished:
+            if isinstance(status.get('result'), str):
+                progress['result'] = status['result']
+            yield sse_event('done', progress)
+            return
+
+        yield sse_event('progress', progress)
+        time.sleep(poll_interval)
@@ -1,8 +1,38 @@
+import os
+import uuid
+
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.views import View
 
 from pan_cnc.lib import cnc_utils
 from pan_cnc.views import CNCBaseFormView
-from .pan_tort import process_hashes
+from .config import get_config_int
+from .metrics import metrics
+from .pan_tort import read_results_page
+from .tasks import get_job_status, stream_job, submit_job
+
+
+def save_hash_file(request, workflow, query_tag):
+    """
+    path of the hash file uploaded with the form, saved in TORT_OUTPUT_DIR so a job on
+    another worker can read it; None when no file was uploaded
+    """
+
+    upload = request.FILES.get('hash_file')
+    if upload is None:
+        # pan-cnc may already have saved the upload and put its path in the workflow
+        path = workflow.get('hash_file')
+        return path if isinstance(path, str) and os.path.isfile(path) else None
+
+    outDir = cnc_utils.get_config_value('TORT_OUTPUT_DIR', '/tmp')
+    path = os.path.join(outDir, f"{query_tag}_{uuid.uuid4().hex}.hashes")
+    with open(path, 'wb') as hash_file:
+        for chunk in upload.chunks():
+            hash_file.write(chunk)
+
+    return path
 
 
 class tortView(CNCBaseFormView):
@@ -21,18 +51,77 @@ class tortView(CNCBaseFormView):
         hashes = workflow.get('hashes')
         output_type = workflow.get('output_type')
         api_key = workflow.get('api_key')
+        bypass_cache = workflow.get('bypass_cache')
+        # the job gets the path of an uploaded hash file, a file handle can't go through the broker
+        hash_file = save_hash_file(self.request, workflow, query_tag)
         payload = {
-            'query_tag': query_tag, 'hashes': hashes,
-            'output_type': output_type, 'api_key': api_key}
+            'query_tag': query_tag, 'hashes': hashes, 'hash_file': hash_file,
+            'output_type': output_type, 'api_key': api_key,
+            'bypass_cache': bypass_cache}
         tortHost = cnc_utils.get_config_value("TORT_HOST", "localhost")
         tortPort = cnc_utils.get_config_value("TORT_PORT", 5010)
 
-        resp = process_hashes(payload)
-        print(f"The response is: {resp}")
+        # large hash lists take far longer than a web request, so run them as a background job
+        job_id = submit_job(payload)
+        print(f"Submitted job {job_id}")
         # resp = requests.post(f'http://{tortHost}:{tortPort}', data=payload)
         # print(resp.headers)
 
         results = super().get_context_data()
-        results['results'] = resp
+        results['results'] = (f"TORT job {job_id} is running.\n"
+                              f"Progress: /tort/job_status?job_id={job_id}\n"
+                              f"Live results: /tort/job_stream?job_id={job_id}\n"
+                              f"Results: /tort/job_results?job_id={job_id}")
 
         return render(self.request, 'pan_cnc/results.html', context=results)
+
+
+class tortJobStatusView(LoginRequiredMixin, View):
+    # json progress of a background job - hashes done, pending and failed with an ETA
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(get_job_status(request.GET.get('job_id', '')))
+
+
+class tortJobResultsView(LoginRequiredMixin, View):
+    # results of a finished background job a page at a time, or its status while it is still running
+    def get(self, request, *args, **kwargs):
+        job_id = request.GET.get('job_id', '')
+        status = get_job_status(job_id)
+        context = {'results': status}
+
+        if status['status'] == 'FAILURE':
+            context['results'] = f"TORT job {job_id} failed: {status['error']}"
+        elif status['status'] == 'SUCCESS' and isinstance(status['result'], str) \
+                and os.path.exists(status['result']):
+            try:
+                page = max(int(request.GET.get('page', 1)), 1)
+            except ValueError:
+                page = 1
+            page_size = max(get_config_int('TORT_RESULTS_PAGE_SIZE', 100), 1)
+            records, total = read_results_page(status['result'], page, page_size)
+            pages = max((total + page_size - 1) // page_size, 1)
+
+            navigation = f"Page {page} of {pages} - {total} hashes"
+            if page > 1:
+                navigation += f"\nPrevious: /tort/job_results?job_id={job_id}&page={page - 1}"
+            if page < pages:
+                navigation += f"\nNext: /tort/job_results?job_id={job_id}&page={page + 1}"
+            context['results'] = f"{navigation}\n\n{records}"
+
+        return render(request, 'pan_cnc/results.html', context=context)
+
+
+class tortJobStreamView(LoginRequiredMixin, View):
+    # server-sent events of a background job - each hash record as soon as it is stored and the job progress
+    def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(stream_job(request.GET.get('job_id', '')), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # keep proxies like nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class tortMetricsView(View):
+    # stage latencies, Autofocus requests and points spent in the Prometheus text format for scraping
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
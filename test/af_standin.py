@@ -0,0 +1,265 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Local Autofocus stand-in for benchmarks
+
+Serves the three Autofocus calls TORT makes - samples/search,
+samples/results/<cookie> and sample/<sha256>/analysis - with a
+configurable queueing delay before a search completes, share of hashes
+that have a sample, 429 responses and padding to grow the responses.
+Whether a hash has a sample is derived from the hash itself so every
+run over the same hashes sees the same hits.
+
+Run it on its own with
+    python test/af_standin.py --port 8765 --delay 2 --hit-ratio 0.7
+and point TORT at it with AUTOFOCUS_API_URL = "http://127.0.0.1:8765/api/v1.0"
+
+'''
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+API_PREFIX = '/api/v1.0'
+
+RESULTS_PATH = re.compile(f'^{API_PREFIX}/samples/results/(?P<cookie>[^/?]+)$')
+ANALYSIS_PATH = re.compile(f'^{API_PREFIX}/sample/(?P<sha256>[0-9a-fA-F]{{64}})/analysis$')
+
+HASH_FIELDS = {32: 'md5', 40: 'sha1', 64: 'sha256'}
+
+
+class StandinSettings:
+    """ how the stand-in behaves, see add_arguments for what each setting does """
+
+    def __init__(self, delay=1.0, coverage_delay=0.0, hit_ratio=0.8, malware_ratio=0.5,
+                 rate_limit_every=0, response_bytes=0):
+        self.delay = delay
+        self.coverage_delay = coverage_delay
+        self.hit_ratio = hit_ratio
+        self.malware_ratio = malware_ratio
+        self.rate_limit_every = rate_limit_every
+        self.response_bytes = response_bytes
+
+
+def add_arguments(parser):
+    """ stand-in settings as command line options, shared with the benchmark """
+
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='seconds a search stays queued/in progress before its results are final')
+    parser.add_argument('--coverage-delay', type=float, default=0.0,
+                        help='seconds each coverage analysis request takes')
+    parser.add_argument('--hit-ratio', type=float, default=0.8,
+                        help='share of hashes that have a sample')
+    parser.add_argument('--malware-ratio', type=float, default=0.5,
+                        help='share of samples with a malware verdict, the rest split between benign and grayware')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='answer every Nth request with 429, 0 never does')
+    parser.add_argument('--response-bytes', type=int, default=0,
+                        help='padding added to every search hit and coverage response')
+
+
+def settings_from_args(args):
+    return StandinSettings(args.delay, args.coverage_delay, args.hit_ratio, args.malware_ratio,
+                           args.rate_limit_every, args.response_bytes)
+
+
+def _fraction(hashvalue, salt):
+    """ stable number in [0, 1) for a hash, so hits and verdicts repeat across runs """
+
+    digest = hashlib.sha256(f'{salt}:{hashvalue.lower()}'.encode()).hexdigest()
+    return int(digest[:8], 16) / 0x100000000
+
+
+def sample_for(hashvalue, settings):
+    """ the _source of the sample behind hashvalue, None when the hash has no sample """
+
+    if _fraction(hashvalue, 'hit') >= settings.hit_ratio:
+        return None
+
+    hashvalue = hashvalue.lower()
+    source = {'md5': hashlib.md5(hashvalue.encode()).hexdigest(),
+              'sha1': hashlib.sha1(hashvalue.encode()).hexdigest(),
+              'sha256': hashlib.sha256(hashvalue.encode()).hexdigest()}
+    source[HASH_FIELDS[len(hashvalue)]] = hashvalue
+
+    verdict = _fraction(hashvalue, 'verdict')
+    if verdict < settings.malware_ratio:
+        source['malware'] = 1
+    else:
+        source['malware'] = 0 if verdict < (1 + settings.malware_ratio) / 2 else 2
+
+    source.update({'filetype': 'PE', 'create_date': '2019-01-01T00:00:00',
+                   'tag': ['Unit42.Standin'], 'size': 1024})
+    if settings.response_bytes:
+        source['padding'] = 'x' * settings.response_bytes
+
+    return source
+
+
+def coverage_for(sha256, settings):
+    """ analysis coverage section with an active, an inactive or no AV signature """
+
+    state = _fraction(sha256, 'coverage')
+    wf_av_sig = []
+    if state < 0.8:
+        wf_av_sig.append({'name': f'Virus/Win32.Standin.{sha256[:6]}', 'status': state < 0.6,
+                          'create_date': '2019-01-02 00:00:00', 'latest_release': '2019-06-01 00:00:00'})
+
+    coverage = {'dns_sig': [], 'wf_av_sig': wf_av_sig, 'fileurl_sig': []}
+    if settings.response_bytes:
+        coverage['padding'] = 'x' * settings.response_bytes
+
+    return coverage
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    """ threaded HTTP server holding the posted searches """
+
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, StandinHandler)
+        self.settings = settings
+        self.searches = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}{API_PREFIX}'
+
+    def rate_limited(self):
+        with self._lock:
+            self.requests += 1
+            every = self.settings.rate_limit_every
+            return every > 0 and self.requests % every == 0
+
+    def add_search(self, hash_list, size):
+        cookie = str(uuid.uuid4())
+        with self._lock:
+            self.searches[cookie] = (time.monotonic(), hash_list, size)
+        return cookie
+
+    def get_search(self, cookie):
+        with self._lock:
+            return self.searches.get(cookie)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        values = json.loads(self.rfile.read(length) or b'{}')
+        server = self.server
+
+        if server.rate_limited():
+            return self._send(429, {'message': 'Minute points exhausted'})
+
+        if not values.get('apiKey'):
+            return self._send(401, {'message': 'Missing apiKey'})
+
+        if self.path == f'{API_PREFIX}/samples/search':
+            return self._search(values)
+
+        match = RESULTS_PATH.match(self.path)
+        if match:
+            return self._results(match.group('cookie'))
+
+        match = ANALYSIS_PATH.match(self.path)
+        if match:
+            return self._analysis(match.group('sha256'))
+
+        return self._send(404, {'message': f'Unknown path {self.path}'})
+
+    def _search(self, values):
+        hash_list = [child['value'] for child in values.get('query', {}).get('children', [])
+                     if child.get('field') == 'alias.hash']
+        cookie = self.server.add_search(hash_list, values.get('size', len(hash_list)))
+
+        return self._send(200, {'af_cookie': cookie, 'af_message': 'search submitted', 'bucket_info': {}})
+
+    def _results(self, cookie):
+        search = self.server.get_search(cookie)
+        if search is None:
+            return self._send(404, {'message': f'Unknown cookie {cookie}'})
+
+        started, hash_list, size = search
+        settings = self.server.settings
+        elapsed = time.monotonic() - started
+        if elapsed < settings.delay:
+            return self._send(200, {'af_in_progress': True, 'total': 0, 'hits': [],
+                                    'af_complete_percentage': int(100 * elapsed / settings.delay)})
+
+        hits = []
+        for hashvalue in hash_list:
+            source = sample_for(hashvalue, settings)
+            if source is not None:
+                hits.append({'_id': source['sha256'], '_source': source})
+
+        return self._send(200, {'af_in_progress': False, 'af_complete_percentage': 100,
+                                'total': len(hits), 'hits': hits[:size]})
+
+    def _analysis(self, sha256):
+        settings = self.server.settings
+        if settings.coverage_delay:
+            time.sleep(settings.coverage_delay)
+
+        return self._send(200, {'coverage': coverage_for(sha256.lower(), settings)})
+
+
+def start_server(settings, host='127.0.0.1', port=0):
+    """ serve on a daemon thread and return the server, port 0 picks a free port """
+
+    server = StandinServer((host, port), settings)
+    threading.Thread(target=server.serve_forever, name='af-standin', daemon=True).start()
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Autofocus stand-in for TORT benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = StandinServer((args.host, args.port), settings_from_args(args))
+    print(f'Autofocus stand-in at {server.api_url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+TORT throughput benchmark
+
+Starts the Autofocus stand-in from af_standin.py and runs processHashList
+against it for synthetic hash lists of each size, reporting throughput,
+p50/p99 latencies per stage and Autofocus request, and peak RSS.
+
+    python test/benchmark.py --sizes 100 10000 100000 --delay 1 --batch-size 100 --pool 8
+
+Each size runs in its own process so peak RSS is per run. The points
+limiter and the local cache are turned off and the run journal and
+results go to a temporary directory. Settings not covered by the options
+below come from .panrc as usual. Latencies are estimated from the
+histogram buckets in tort.metrics.
+
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+from af_standin import add_arguments, settings_from_args, start_server  # noqa: E402
+
+HASH_LENGTHS = {'md5': 32, 'sha1': 40, 'sha256': 64}
+
+# stages and requests reported in the table, see tort.metrics for all of them
+REPORT_STAGES = ('search', 'batch_search', 'poll', 'poll_and_coverage', 'coverage', 'store')
+
+
+def synthetic_hashes(count, hash_type='mixed', seed=42):
+    """ count unique random hashes, mixed cycles through md5, sha1 and sha256 """
+
+    rng = random.Random(seed)
+    lengths = list(HASH_LENGTHS.values()) if hash_type == 'mixed' else [HASH_LENGTHS[hash_type]]
+
+    hashes = set()
+    while len(hashes) < count:
+        length = lengths[len(hashes) % len(lengths)]
+        hashes.add('%0*x' % (length, rng.getrandbits(length * 4)))
+
+    return sorted(hashes)
+
+
+def benchmark_settings(args, work_dir):
+    """ TORT settings for a benchmark run, layered over .panrc """
+
+    settings = {'AUTOFOCUS_API_URL': args.api_url,
+            'AUTOFOCUS_MINUTE_POINTS': 0,
+            'AUTOFOCUS_DAILY_POINTS': 0,
+                'TORT_CACHE_ENABLED': 'false',
+                'TORT_JOURNAL_PATH': os.path.join(work_dir, 'journal.sqlite3'),
+                'TORT_OUTPUT_DIR': work_dir,
+                'TORT_BATCH_SIZE': args.batch_size,
+                'TORT_POOL_COUNT': args.pool,
+                'TORT_HTTP_POOL_SIZE': args.http_pool,
+                'TORT_POLL_INITIAL_DELAY': args.poll_delay,
+                'TORT_HTTP_RETRY_BACKOFF': args.retry_backoff}
+    if args.coverage_workers:
+        settings['TORT_COVERAGE_WORKERS'] = args.coverage_workers
+
+    return settings
+
+
+def run_one(args):
+    """ run processHashList once in this process and print the measurements as json """
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        settings = benchmark_settings(args, work_dir)
+
+        from pan_cnc.lib import cnc_utils
+        get_config_value = cnc_utils.get_config_value
+
+        def benchmark_config_value(key, default=None):
+            if key in settings:
+                return settings[key]
+            return get_config_value(key, default)
+
+        cnc_utils.get_config_value = benchmark_config_value
+
+        from tort.metrics import metrics, run_summary
+        from tort.pan_tort import processHashList
+
+        hash_list = synthetic_hashes(args.run, args.hash_type)
+        before = metrics.snapshot()
+        started = time.monotonic()
+        # TORT prints a few lines per hash, keep them out of the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            processHashList(hash_list, 'text', f'benchmark-{args.run}-{int(time.time())}', 'MD5', 'benchmark')
+        elapsed = time.monotonic() - started
+        summary = run_summary(before, metrics.snapshot())
+
+    # ru_maxrss is in kilobytes on Linux
+    print(json.dumps({'hashes': args.run,
+                      'seconds': round(elapsed, 2),
+                      'hashes_per_second': round(args.run / elapsed, 1),
+                      'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                      'summary': summary}))
+
+
+def format_latency(latency):
+    if latency is None:
+        return '-'
+    return f"{latency['p50']}/{latency['p99']}"
+
+
+def report(result):
+    summary = result['summary']
+    print(f"\n{result['hashes']} hashes in {result['seconds']}s - {result['hashes_per_second']} hashes/s, "
+          f"peak RSS {result['peak_rss_mb']} MB")
+    print(f"  Autofocus points {sum(summary['points'].values())}, responses {summary['responses']}, "
+          f"{summary['bytes_received']} bytes received, polls per cookie "
+          f"p50/p99 {format_latency(summary['polls_per_cookie'])}")
+    for stage in REPORT_STAGES:
+        if stage in summary['stage_seconds']:
+            print(f"  stage {stage:18} p50/p99 {format_latency(summary['stage_seconds'][stage])} s "
+                  f"({summary['stage_seconds'][stage]['count']} runs)")
+    for action, latency in sorted(summary['request_seconds'].items()):
+        print(f"  request {action:16} p50/p99 {format_latency(latency)} s ({latency['count']} requests)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TORT against a local Autofocus stand-in')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='hash list sizes to run')
+    parser.add_argument('--hash-type', choices=['mixed'] + sorted(HASH_LENGTHS), default='mixed')
+    parser.add_argument('--batch-size', type=int, default=100, help='TORT_BATCH_SIZE')
+    parser.add_argument('--pool', type=int, default=8, help='TORT_POOL_COUNT')
+    parser.add_argument('--coverage-workers', type=int, default=0, help="TORT_COVERAGE_WORKERS, default TORT's own")
+    parser.add_argument('--http-pool', type=int, default=20, help='TORT_HTTP_POOL_SIZE')
+    parser.add_argument('--poll-delay', type=float, default=0.5, help='TORT_POLL_INITIAL_DELAY')
+    parser.add_argument('--retry-backoff', type=float, default=0.1, help='TORT_HTTP_RETRY_BACKOFF')
+    parser.add_argument('--api-url', help='benchmark an already running stand-in instead of starting one')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.run:
+        return run_one(args)
+
+    if not args.api_url:
+        server = start_server(settings_from_args(args))
+        args.api_url = server.api_url
+        print(f"Autofocus stand-in at {args.api_url}")
+
+    for size in args.sizes:
+        command = [sys.executable, os.path.abspath(__file__), '--run', str(size),
+                   '--api-url', args.api_url, '--batch-size', str(args.batch_size), '--pool', str(args.pool),
+                   '--coverage-workers', str(args.coverage_workers), '--http-pool', str(args.http_pool),
+                   '--poll-delay', str(args.poll_delay), '--retry-backoff', str(args.retry_backoff),
+                   '--hash-type', args.hash_type]
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout.decode()
+        report(json.loads(output.strip().splitlines()[-1]))
+
+
+if __name__ == '__main__':
+    main()
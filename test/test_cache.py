@@ -0,0 +1,96 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+'''
+Tests for the TTLs of the local hash cache in tort.cache
+'''
+
+import pytest
+
+# the TORT settings are read through the pan-cnc framework
+pytest.importorskip('pan_cnc')
+
+from tort import cache as cache_module  # noqa: E402
+from tort.cache import HashCache  # noqa: E402
+from tort.records import SOURCE_CACHE  # noqa: E402
+
+MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+
+COVERAGE = {'dns_sig': [], 'wf_av_sig': [{'name': 'Virus/Win32.WGeneric', 'status': True}], 'fileurl_sig': []}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return HashCache(str(tmp_path / 'cache.sqlite3'), verdict_ttl=100, coverage_ttl=50, max_entries=10,
+                     no_sample_ttl=10)
+
+
+def test_sample_is_served_until_the_verdict_ttl(cache, clock):
+    cache.put_sample(MD5, {'hashvalue': MD5, 'verdict': 'malware'})
+
+    clock.now += 100
+    sample = cache.get_sample(MD5.upper())
+    assert sample['verdict'] == 'malware'
+    assert sample['source'] == SOURCE_CACHE
+
+    clock.now += 1
+    assert cache.get_sample(MD5) is None
+
+
+def test_no_sample_found_expires_at_the_no_sample_ttl(cache, clock):
+    cache.put_sample(MD5, {'hashvalue': MD5, 'verdict': 'No sample found'})
+
+    clock.now += 10
+    assert cache.get_sample(MD5)['verdict'] == 'No sample found'
+
+    clock.now += 1
+    assert cache.get_sample(MD5) is None
+
+
+def test_coverage_has_its_own_ttl(cache, clock):
+    cache.put_sample(MD5, dict(COVERAGE, hashvalue=MD5, verdict='malware'))
+    cache.put_coverage(MD5, COVERAGE)
+
+    # the sample data is cached without the coverage fields
+    assert 'wf_av_sig' not in cache.get_sample(MD5)
+    assert cache.get_coverage(MD5) == COVERAGE
+
+    clock.now += 51
+    assert cache.get_coverage(MD5) is None
+    assert cache.get_sample(MD5)['verdict'] == 'malware'
+
+
+def test_refreshed_sample_restarts_its_ttl(cache, clock):
+    cache.put_sample(MD5, {'hashvalue': MD5, 'verdict': 'No sample found'})
+    clock.now += 20
+    cache.put_sample(MD5, {'hashvalue': MD5, 'verdict': 'benign'})
+
+    clock.now += 50
+    assert cache.get_sample(MD5)['verdict'] == 'benign'
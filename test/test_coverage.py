@@ -0,0 +1,84 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Tests for signature state and coverage classification in tort.coverage
+'''
+
+import pytest
+
+from tort.coverage import ACTIVE, INACTIVE, NO_SIG, coverage_breakdown, coverage_status, parse_coverage, \
+    parse_signature, signature_state
+
+
+@pytest.mark.parametrize('entry, state', [
+    ({'status': True}, ACTIVE),
+    ({'status': False}, INACTIVE),
+    ({'status': 'true'}, ACTIVE),
+    ({'status': ' True '}, ACTIVE),
+    ({'status': 'active'}, ACTIVE),
+    ({'status': '1'}, ACTIVE),
+    ({'status': 'false'}, INACTIVE),
+    ({'status': '0'}, INACTIVE),
+    ({'state': 'inactive'}, INACTIVE),
+    ({}, INACTIVE),
+])
+def test_signature_state(entry, state):
+    assert signature_state(entry) == state
+
+
+@pytest.mark.parametrize('status', ['untrue', 'not true', 'true-ish'])
+def test_signature_state_needs_true_not_a_string_containing_it(status):
+    assert signature_state({'status': status}) == INACTIVE
+
+
+def test_parse_signature_keeps_the_first_field_present():
+    entry = {'name': 'Trojan/Win32.x', 'status': 'true', 'first_daily_release': 100, 'latest_release': 200,
+             'latest_daily_release': 150, 'extra': 'dropped'}
+
+    assert parse_signature(entry) == {'state': ACTIVE, 'name': 'Trojan/Win32.x',
+                                      'first_release': 100, 'latest_release': 200}
+
+
+def test_parse_signature_of_a_record_returns_it_unchanged():
+    record = parse_signature({'name': 'sig', 'domain': 'bad.example', 'status': False, 'create_date': 1})
+
+    assert parse_signature(record) == record
+
+
+def test_parse_coverage_has_every_signature_type():
+    coverage = parse_coverage({'dns_sig': [{'name': 'a', 'status': True}], 'wf_av_sig': None})
+
+    assert coverage == {'dns_sig': [{'state': ACTIVE, 'name': 'a'}], 'wf_av_sig': [], 'fileurl_sig': []}
+
+
+def test_coverage_breakdown_counts_per_type():
+    sample_data = {'dns_sig': [{'state': ACTIVE}, {'state': INACTIVE}, {'state': ACTIVE}],
+                   'fileurl_sig': [{'status': 'false'}]}
+
+    assert coverage_breakdown(sample_data) == {'dns_sig': {ACTIVE: 2, INACTIVE: 1},
+                                               'wf_av_sig': {ACTIVE: 0, INACTIVE: 0},
+                                               'fileurl_sig': {ACTIVE: 0, INACTIVE: 1}}
+
+
+@pytest.mark.parametrize('sample_data, status', [
+    ({'wf_av_sig': [{'state': INACTIVE}], 'dns_sig': [{'state': ACTIVE}]}, ACTIVE),
+    ({'wf_av_sig': [{'state': INACTIVE}], 'fileurl_sig': [{'status': 'untrue'}]}, INACTIVE),
+    ({'wf_av_sig': [], 'dns_sig': None}, NO_SIG),
+    ({'verdict': 'No sample found'}, NO_SIG),
+])
+def test_coverage_status(sample_data, status):
+    assert coverage_status(sample_data) == status
@@ -0,0 +1,88 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Tests for hash list parsing in tort.hash_parser
+'''
+
+import io
+
+import pytest
+
+from tort.hash_parser import HashParser, hash_type, iter_tokens
+
+MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+SHA1 = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+SHA256 = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+
+@pytest.mark.parametrize('hashvalue, expected', [
+    (MD5, 'MD5'),
+    (SHA1, 'SHA1'),
+    (SHA256, 'SHA256'),
+    (MD5.upper(), 'MD5'),
+    (MD5[:-1], None),
+    (MD5[:-1] + 'g', None),
+    ('', None),
+])
+def test_hash_type(hashvalue, expected):
+    assert hash_type(hashvalue) == expected
+
+
+@pytest.mark.parametrize('delimiter', ['\n', '\r\n', ',', ';', '|', '\t', ' ', '%0A', '%0d%0a', '\\n', '\\r\\n', ', '])
+def test_delimiters(delimiter):
+    assert list(iter_tokens(delimiter.join([MD5, SHA1, SHA256]) + delimiter)) == [MD5, SHA1, SHA256]
+
+
+def test_mixed_delimiters_and_lines():
+    lines = io.StringIO(f"{MD5},{SHA1}%0A\n  {SHA256}\\n\n\n")
+
+    assert list(iter_tokens(lines)) == [MD5, SHA1, SHA256]
+
+
+def test_bytes_are_decoded():
+    assert list(iter_tokens([MD5.encode() + b'\n', SHA1.encode()])) == [MD5, SHA1]
+
+
+def test_parse_lowercases_and_drops_duplicates_in_order():
+    parser = HashParser()
+
+    hashes = list(parser.parse(f"{SHA1}\n{MD5.upper()}\n{MD5}\n{SHA1}"))
+
+    assert hashes == [SHA1, MD5]
+    assert parser.duplicates == 2
+    assert parser.rejects == []
+
+
+def test_parse_keeps_rejects():
+    parser = HashParser()
+
+    hashes = list(parser.parse(f"md5,{MD5},{MD5[:-2]},not-a-hash,{SHA256}z"))
+
+    assert hashes == [MD5]
+    assert parser.rejects == ['md5', MD5[:-2], 'not-a-hash', SHA256 + 'z']
+    assert parser.summary() == {'accepted': 1, 'rejected': 4, 'duplicates': 0}
+
+
+def test_parse_counts_duplicates_across_sources():
+    parser = HashParser()
+
+    first = list(parser.parse(MD5))
+    second = list(parser.parse([MD5 + '\n', SHA1 + '\n']))
+
+    assert first == [MD5]
+    assert second == [SHA1]
+    assert parser.summary() == {'accepted': 2, 'rejected': 0, 'duplicates': 1}
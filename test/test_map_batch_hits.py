@@ -0,0 +1,67 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Tests for mapping the hits of a batched search back to each hash in tort.pan_tort
+'''
+
+import pytest
+
+# pan_tort needs the pan-cnc framework and the Autofocus and Elasticsearch clients
+for module in ('pan_cnc', 'aiohttp', 'elasticsearch', 'elasticsearch_dsl'):
+    pytest.importorskip(module)
+
+from tort.pan_tort import map_batch_hits  # noqa: E402
+
+MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+SHA1 = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+SHA256 = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+
+def hit(**source):
+    return {'_source': source}
+
+
+def test_hits_map_to_their_hash_by_any_hash_type():
+    first = hit(md5=MD5, sha1='1' * 40, sha256='1' * 64)
+    second = hit(md5='2' * 32, sha1=SHA1, sha256='2' * 64)
+    third = hit(md5='3' * 32, sha1='3' * 40, sha256=SHA256)
+
+    mapped = map_batch_hits([MD5, SHA1, SHA256], {'hits': [first, second, third]})
+
+    assert mapped == {MD5: first['_source'], SHA1: second['_source'], SHA256: third['_source']}
+
+
+def test_hash_without_a_hit_maps_to_none():
+    assert map_batch_hits([MD5, SHA1], {'hits': [hit(md5=MD5)]}) == {MD5: {'md5': MD5}, SHA1: None}
+
+
+def test_no_hits():
+    assert map_batch_hits([MD5], {}) == {MD5: None}
+    assert map_batch_hits([], {'hits': [hit(md5=MD5)]}) == {}
+
+
+def test_first_hit_wins():
+    newest = hit(md5=MD5, verdict=1)
+
+    assert map_batch_hits([MD5], {'hits': [newest, hit(md5=MD5, verdict=0)]}) == {MD5: newest['_source']}
+
+
+def test_matching_ignores_case():
+    source = {'sha256': SHA256.upper()}
+
+    assert map_batch_hits([SHA256, SHA256.upper()], {'hits': [{'_source': source}]}) == \
+        {SHA256: source, SHA256.upper(): source}
@@ -0,0 +1,89 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+
+'''
+Tests for the coroutine stages of tort.pipeline
+'''
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from tort.pipeline import Pipeline, Stage
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_coroutine_stage_keeps_workers_items_in_flight(loop):
+    running = {'now': 0, 'peak': 0}
+
+    async def double(item):
+        running['now'] += 1
+        running['peak'] = max(running['peak'], running['now'])
+        await asyncio.sleep(0.05)
+        running['now'] -= 1
+        return [item * 2]
+
+    pipeline = Pipeline([Stage('search', double, 100, loop=loop), Stage('store', lambda item: [item])], 10)
+
+    assert sorted(pipeline.run(range(300))) == [item * 2 for item in range(300)]
+    assert running['peak'] == 100
+
+
+def test_coroutine_stage_passes_failed_items_to_on_error(loop):
+    async def fail_odd(item):
+        if item % 2:
+            raise ValueError(item)
+        return [item]
+
+    pipeline = Pipeline([Stage('search', fail_odd, 4, on_error=lambda item, error: [-item], loop=loop)])
+
+    assert sorted(pipeline.run(range(6))) == [-5, -3, -1, 0, 2, 4]
+
+
+def test_stopped_coroutine_stage_cancels_what_is_in_flight(loop):
+    running = {'now': 0, 'cancelled': 0}
+
+    async def slow(item):
+        running['now'] += 1
+        try:
+            await asyncio.sleep(0 if item == 0 else 10)
+        except asyncio.CancelledError:
+            running['cancelled'] += 1
+            raise
+        finally:
+            running['now'] -= 1
+        return [item]
+
+    pipeline = Pipeline([Stage('search', slow, 20, loop=loop)])
+    for item in pipeline.run(range(1000)):
+        while running['now'] < 20:
+            time.sleep(0.01)
+        break
+
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0.2), loop).result()
+    assert running == {'now': 0, 'cancelled': 20}
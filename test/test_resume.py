@@ -0,0 +1,127 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+'''
+Tests for resuming a run: the run journal in tort.journal, compacting the
+results file and recounting the run stats
+'''
+
+import json
+
+import pytest
+
+# the TORT settings are read through the pan-cnc framework
+pytest.importorskip('pan_cnc')
+
+from tort.journal import COVERED, QUEUED, SEARCHED, STORED, RunInProgress, RunJournal  # noqa: E402
+from tort.records import HashRecord  # noqa: E402
+from tort.result_writer import ResultWriter, compact_results, iter_results  # noqa: E402
+from tort.run_stats import RunStats  # noqa: E402
+
+HASHES = ['%032x' % number for number in range(3)]
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return RunJournal(str(tmp_path / 'journal.sqlite3'), lease_seconds=60)
+
+
+def write_results(path, records):
+    with ResultWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+
+
+def test_unfinished_run_resumes_with_its_output_file(journal):
+    assert journal.start_run('tag', 'first.ndjson', 'a') == ('first.ndjson', False)
+    journal.release('tag', 'a')
+
+    assert journal.start_run('tag', 'second.ndjson', 'b') == ('first.ndjson', True)
+
+
+def test_finished_run_starts_over(journal):
+    journal.start_run('tag', 'first.ndjson', 'a')
+    journal.queue('tag', HASHES)
+    journal.finish_run('tag')
+
+    assert journal.start_run('tag', 'second.ndjson', 'a') == ('second.ndjson', False)
+    assert journal.get_entry('tag', HASHES[0]).state == QUEUED
+    assert journal.hashes_in_state('tag', QUEUED) == set()
+
+
+def test_leased_run_is_not_resumed_by_another_owner(journal):
+    journal.start_run('tag', 'first.ndjson', 'a')
+
+    with pytest.raises(RunInProgress):
+        journal.start_run('tag', 'second.ndjson', 'b')
+
+
+def test_searched_hash_keeps_its_cookie_until_reset(journal):
+    journal.start_run('tag', 'out.ndjson', 'a')
+    journal.queue('tag', HASHES)
+    journal.searched('tag', HASHES[:2], 'cookie')
+
+    entry = journal.get_entry('tag', HASHES[0])
+    assert (entry.state, entry.cookie) == (SEARCHED, 'cookie')
+
+    journal.reset('tag', HASHES[:1])
+    entry = journal.get_entry('tag', HASHES[0])
+    assert (entry.state, entry.cookie) == (QUEUED, None)
+
+
+def test_only_covered_hashes_are_stored(journal):
+    journal.start_run('tag', 'out.ndjson', 'a')
+    journal.queue('tag', HASHES)
+    journal.covered('tag', HASHES[0], HashRecord(hashvalue=HASHES[0], verdict='benign'))
+    journal.covered_records('tag', {HASHES[1]: HashRecord(hashvalue=HASHES[1], verdict='malware')})
+
+    entry = journal.get_entry('tag', HASHES[1])
+    assert entry.state == COVERED
+    assert entry.record['verdict'] == 'malware'
+
+    journal.stored('tag', HASHES)
+    assert journal.hashes_in_state('tag', STORED) == set(HASHES[:2])
+    assert journal.hashes_in_state('tag', QUEUED) == {HASHES[2]}
+    assert journal.get_entry('tag', HASHES[0]).record is None
+
+
+@pytest.mark.parametrize('name', ['out.ndjson', 'out.ndjson.gz'])
+def test_compact_results_keeps_the_last_record_of_each_stored_hash(tmp_path, name):
+    path = str(tmp_path / name)
+    write_results(path, [{'hashvalue': HASHES[0]},
+                         {'hashvalue': HASHES[1], 'verdict': 'benign'},
+                         {'hashvalue': HASHES[0], 'verdict': 'malware'},
+                         {'hashvalue': HASHES[2]}])
+
+    assert compact_results(path, set(HASHES[:2])) == 2
+    assert list(iter_results(path)) == [{'hashvalue': HASHES[1], 'verdict': 'benign'},
+                                        {'hashvalue': HASHES[0], 'verdict': 'malware'}]
+
+
+def test_resumed_stats_are_recounted_from_the_results_file(tmp_path):
+    results_file = str(tmp_path / 'out.ndjson')
+    stats_file = str(tmp_path / 'out.stats.json')
+    write_results(results_file, [{'hashvalue': HASHES[0], 'verdict': 'benign', 'filetype': 'PE'},
+                                 {'hashvalue': HASHES[1], 'verdict': 'No sample found'}])
+    # stale tallies from before the results file was compacted
+    with open(stats_file, 'w') as stats:
+        json.dump({'counters': {'total samples': 5, 'failed': 3}}, stats)
+
+    stats = RunStats(stats_file, resume=True, results_file=results_file)
+    stats.write({'hashvalue': HASHES[2]})
+    counters = stats.close()['counters']
+
+    assert (counters['total samples'], counters['benign'], counters['No sample found'], counters['failed']) == \
+        (3, 1, 1, 1)
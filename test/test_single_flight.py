@@ -0,0 +1,119 @@
+# Copyright (c) 2018, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Author: SP-Solutions <sp-solutions@paloaltonetworks.com>
+'''
+Tests for sharing Autofocus lookups across jobs with tort.single_flight
+'''
+
+import asyncio
+import threading
+
+import pytest
+
+# the TORT settings are read through the pan-cnc framework
+pytest.importorskip('pan_cnc')
+
+from tort.records import HashRecord, copy_record  # noqa: E402
+from tort.single_flight import SingleFlight  # noqa: E402
+
+
+@pytest.fixture
+def inflight():
+    return SingleFlight(memo_seconds=60, copy=copy_record)
+
+
+def test_waiters_share_the_leaders_lookup(inflight):
+    future, leader = inflight.claim('sample')
+    waiter, waiting_leader = inflight.claim('sample')
+    assert (leader, waiting_leader) == (True, False)
+
+    record = HashRecord(verdict='malware')
+    inflight.resolve('sample', record)
+
+    shared = inflight.wait(waiter)
+    assert shared == record
+    # every caller gets its own copy to add coverage to
+    assert shared is not record
+
+
+def test_finished_lookup_is_memoized_unless_the_caller_bypasses_it(inflight):
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        return HashRecord(verdict='benign')
+
+    assert inflight.do('sample', lookup)['verdict'] == 'benign'
+    assert inflight.do('sample', lookup)['verdict'] == 'benign'
+    assert len(calls) == 1
+
+    inflight.do('sample', lookup, use_memo=False)
+    assert len(calls) == 2
+
+
+def test_memo_expires(inflight, monkeypatch):
+    inflight.do('sample', lambda: HashRecord(verdict='benign'))
+
+    now = inflight._memo['sample'][0] + 1
+    monkeypatch.setattr('tort.single_flight.time.monotonic', lambda: now)
+
+    assert inflight.claim('sample')[1] is True
+
+
+def test_failed_lookup_is_not_memoized_and_its_waiter_runs_its_own(inflight):
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait()
+        raise ValueError('key out of points')
+
+    def leader():
+        with pytest.raises(ValueError):
+            inflight.do('sample', failing)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait()
+
+    waiter, _ = inflight.claim('sample')
+    release.set()
+    thread.join()
+
+    with pytest.raises(ValueError):
+        inflight.wait(waiter)
+    assert inflight.do('sample', lambda: HashRecord(verdict='grayware'))['verdict'] == 'grayware'
+
+
+def test_async_waiters_share_one_lookup(inflight):
+    calls = []
+
+    async def lookup():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return HashRecord(verdict='malware')
+
+    async def lookups():
+        return await asyncio.gather(*(inflight.do_async('sample', lookup) for _ in range(5)))
+
+    loop = asyncio.new_event_loop()
+    try:
+        records = loop.run_until_complete(lookups())
+    finally:
+        loop.close()
+
+    assert [record['verdict'] for record in records] == ['malware'] * 5
+    assert len(calls) == 1